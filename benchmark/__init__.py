@@ -0,0 +1,8 @@
+"""
+load testing against a simulated OpenAI upstream, see `python -m benchmark --help`
+
+    fake_openai:    fake chat completions server with configurable TTFT, token rate, jitter and error rate
+    serve:          the chat room server pointed at it
+    load:           websocket clients asking ChatGPT
+    report:         throughput, latency percentiles and server CPU / RSS
+"""
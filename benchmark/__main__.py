@@ -0,0 +1,66 @@
+"""
+end-to-end run: fake upstream, chat room server and load generator, then the report
+
+    python -m benchmark --clients 50 --messages 5 --tokens-per-second 40 --output cache/bench.json
+"""
+import sys
+import time
+import socket
+import argparse
+import subprocess
+
+from .load import add_arguments, run
+
+
+def wait_for_port(port: int, timeout: float = 30.):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1.):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError(f'nothing listening on port {port} after {timeout} seconds')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='load test the chat room against a simulated upstream')
+    add_arguments(parser)
+    parser.add_argument('--port', type=int, default=8080, help='chat room server port')
+    parser.add_argument('--upstream-port', type=int, default=8765)
+    parser.add_argument('--ttft', type=float, default=0.4)
+    parser.add_argument('--tokens-per-second', type=float, default=40.)
+    parser.add_argument('--jitter', type=float, default=0.3)
+    parser.add_argument('--error-rate', type=float, default=0.)
+    parser.add_argument('--reply-tokens', type=int, default=200)
+    parser.add_argument('--no-cache', action='store_true', help='disable the response cache and single flight')
+    parser.add_argument('--server-log', default='/dev/null', help='stdout / stderr of the chat room server')
+    args = parser.parse_args()
+    args.url = f'http://127.0.0.1:{args.port}'
+
+    upstream_cmd = [sys.executable, '-m', 'benchmark.fake_openai', '--port', str(args.upstream_port),
+                    '--ttft', str(args.ttft), '--tokens-per-second', str(args.tokens_per_second),
+                    '--jitter', str(args.jitter), '--error-rate', str(args.error_rate),
+                    '--reply-tokens', str(args.reply_tokens)]
+    server_cmd = [sys.executable, '-m', 'benchmark.serve', '--port', str(args.port),
+                  '--upstream', f'http://127.0.0.1:{args.upstream_port}/v1']
+    if args.no_cache:
+        server_cmd.append('--no-cache')
+
+    processes = []
+    with open(args.server_log, 'w') as server_log:
+        try:
+            processes.append(subprocess.Popen(upstream_cmd))
+            processes.append(subprocess.Popen(server_cmd, stdout=server_log, stderr=subprocess.STDOUT))
+            wait_for_port(args.upstream_port)
+            wait_for_port(args.port)
+            run(args, server_pid=processes[-1].pid)
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait()
+
+
+if __name__ == '__main__':
+    main()
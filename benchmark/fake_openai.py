@@ -0,0 +1,105 @@
+"""
+local stand-in for the OpenAI chat completions endpoint, streaming made-up tokens at a configurable pace
+
+    python -m benchmark.fake_openai --port 8765 --ttft 0.4 --tokens-per-second 40 --jitter 0.3 --error-rate 0.01
+"""
+import json
+import time
+import random
+import asyncio
+import argparse
+from dataclasses import dataclass
+
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do', 'eiusmod',
+         'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua']
+
+
+@dataclass
+class UpstreamProfile:
+    ttft: float = 0.4                   # seconds before the first token
+    tokens_per_second: float = 40.      # pace of the following tokens
+    jitter: float = 0.3                 # relative, each delay is scaled by a random factor in [1 - jitter, 1 + jitter]
+    error_rate: float = 0.              # share of requests failing with `error_status`
+    error_status: int = 500
+    reply_tokens: int = 200             # tokens per streamed reply
+    summary_tokens: int = 60            # tokens per non-streamed reply, i.e. context summaries
+
+    def delay(self, seconds: float) -> float:
+        return max(0., seconds * (1. + random.uniform(-self.jitter, self.jitter)))
+
+
+def make_text(n_tokens: int) -> list:
+    return [random.choice(WORDS) + ' ' for _ in range(n_tokens)]
+
+
+def sse_chunk(content: str = None, finish_reason: str = None) -> bytes:
+    delta = {} if content is None else {'content': content}
+    chunk = {
+        'id': 'chatcmpl-bench',
+        'object': 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': 'gpt-3.5-turbo-0301',
+        'choices': [{'delta': delta, 'index': 0, 'finish_reason': finish_reason}],
+    }
+    return f'data: {json.dumps(chunk)}\n\n'.encode('utf-8')
+
+
+def create_app(profile: UpstreamProfile) -> FastAPI:
+    app = FastAPI()
+
+    @app.post('/v1/chat/completions')
+    async def chat_completions(body: dict):
+        if random.random() < profile.error_rate:
+            error = {'error': {'message': 'simulated upstream error', 'type': 'server_error'}}
+            return JSONResponse(error, status_code=profile.error_status)
+
+        if not body.get('stream'):
+            await asyncio.sleep(profile.delay(profile.ttft + profile.summary_tokens / profile.tokens_per_second))
+            message = {'role': 'assistant', 'content': ''.join(make_text(profile.summary_tokens))}
+            return {'choices': [{'message': message, 'index': 0, 'finish_reason': 'stop'}]}
+
+        async def stream():
+            await asyncio.sleep(profile.delay(profile.ttft))
+            yield sse_chunk()   # the role-only delta the real API opens with
+            for i, token in enumerate(make_text(profile.reply_tokens)):
+                if i > 0:
+                    await asyncio.sleep(profile.delay(1. / profile.tokens_per_second))
+                yield sse_chunk(token)
+            yield sse_chunk(finish_reason='stop')
+            yield b'data: [DONE]\n\n'
+
+        return StreamingResponse(stream(), media_type='text/event-stream')
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fake OpenAI chat completions server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--ttft', type=float, default=UpstreamProfile.ttft)
+    parser.add_argument('--tokens-per-second', type=float, default=UpstreamProfile.tokens_per_second)
+    parser.add_argument('--jitter', type=float, default=UpstreamProfile.jitter)
+    parser.add_argument('--error-rate', type=float, default=UpstreamProfile.error_rate)
+    parser.add_argument('--error-status', type=int, default=UpstreamProfile.error_status)
+    parser.add_argument('--reply-tokens', type=int, default=UpstreamProfile.reply_tokens)
+    args = parser.parse_args()
+
+    profile = UpstreamProfile(
+        ttft=args.ttft,
+        tokens_per_second=args.tokens_per_second,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        reply_tokens=args.reply_tokens,
+    )
+    uvicorn.run(create_app(profile), host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""
+load generator: N websocket clients in the chat room, each asking ChatGPT M questions one after the other
+
+    python -m benchmark.load --url http://127.0.0.1:8080 --clients 50 --messages 5 --server-pid 12345
+"""
+import json
+import time
+import random
+import asyncio
+import argparse
+from typing import List, Optional
+
+import httpx
+import websockets
+
+from config.config_en import Args
+from .report import ResourceSampler, build_report, format_report, save_report
+
+
+ERROR_MESSAGES = [Args.UNKNOWN_NETWORK_ERR_MSG, Args.UNKNOWN_RUNTIME_ERR_MSG]
+
+
+class Request(object):
+    """
+    one @chatgpt message of a client, followed through the frames the client receives
+    """
+
+    def __init__(self, user: str):
+        self.user: str = user
+        self.sent: float = time.perf_counter()
+        self.started: bool = False      # head line of the reply received
+        self.first_delta: Optional[float] = None
+        self.done: Optional[float] = None
+        self.status: str = 'pending'
+        self.n_chars: int = 0
+        self.n_notices: int = 0         # queue position, rate limit, ... before the reply started
+
+    def feed(self, frame: dict) -> bool:
+        """
+        returns True once the reply is complete
+        """
+        if frame.get('receiver', '') != self.user:
+            return False
+        complete = frame.get('complete', True)
+        message = frame.get('message', '')
+        if not complete:
+            if len(frame.get('time_str', '')) > 0:
+                self.started = True
+            else:
+                if self.first_delta is None:
+                    self.first_delta = time.perf_counter()
+                self.n_chars += len(message)
+            return False
+        if not self.started:
+            self.n_notices += 1
+            return False
+        self.done = time.perf_counter()
+        self.status = 'error' if any(error in message for error in ERROR_MESSAGES) else 'ok'
+        return True
+
+    def result(self, n_frames: int) -> dict:
+        return {
+            'user': self.user,
+            'status': self.status,
+            'first_delta': self.first_delta - self.sent if self.first_delta is not None else None,
+            'latency': self.done - self.sent if self.done is not None else None,
+            'n_chars': self.n_chars,
+            'n_notices': self.n_notices,
+            'n_frames': n_frames,
+        }
+
+
+async def register(client: httpx.AsyncClient, user: str) -> str:
+    response = await client.post('/api/register', json={'username': user})
+    response.raise_for_status()
+    if not response.json()['status']:
+        raise ValueError(f"user name '{user}' is taken")
+    return response.headers['set-cookie'].split(';')[0]
+
+
+async def run_client(index: int, args, results: List[dict]):
+    user = f'{args.prefix}{index}'
+    await asyncio.sleep(random.uniform(0, args.ramp))
+    async with httpx.AsyncClient(base_url=args.url) as client:
+        cookie = await register(client, user)
+    ws_url = args.url.replace('http', 'ws', 1) + f'/api/chat?room={args.room}'
+
+    async with websockets.connect(ws_url, extra_headers={'Cookie': cookie}, max_size=None) as websocket:
+        if args.subscription != 'all':
+            await websocket.send(json.dumps({'control': 'subscribe', 'subscription': args.subscription}))
+        for i in range(args.messages):
+            request = Request(user)
+            await websocket.send(json.dumps({'sender': user, 'message': f'@chatgpt question {i} from {user}'}))
+            n_frames = 0
+            deadline = time.perf_counter() + args.timeout
+            try:
+                while True:
+                    text = await asyncio.wait_for(websocket.recv(), timeout=max(0., deadline - time.perf_counter()))
+                    n_frames += 1
+                    if request.feed(json.loads(text)):
+                        break
+            except asyncio.TimeoutError:
+                request.status = 'timeout'
+            results.append(request.result(n_frames))
+            if args.think > 0:
+                await asyncio.sleep(random.expovariate(1. / args.think))
+
+
+async def run_load(args) -> tuple:
+    results: List[dict] = []
+    start = time.perf_counter()
+    outcomes = await asyncio.gather(*[run_client(i, args, results) for i in range(args.clients)],
+                                    return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    for outcome in outcomes:
+        if isinstance(outcome, Exception):
+            print(f'client failed: {outcome!r}')
+    return results, elapsed
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--url', default='http://127.0.0.1:8080', help='chat room server')
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=5, help='questions per client, asked one after the other')
+    parser.add_argument('--think', type=float, default=0., help='mean pause between questions, in seconds')
+    parser.add_argument('--ramp', type=float, default=1., help='clients connect within this many seconds')
+    parser.add_argument('--timeout', type=float, default=120., help='per reply, in seconds')
+    parser.add_argument('--subscription', default='all', choices=['all', 'self'])
+    parser.add_argument('--room', default=Args.DEFAULT_ROOM)
+    parser.add_argument('--prefix', default='bench', help='user names are <prefix><index>')
+    parser.add_argument('--output', default=None, help='write the report as JSON to this file')
+
+
+def run(args, server_pid: Optional[int] = None) -> dict:
+    sampler = ResourceSampler(server_pid) if server_pid is not None else None
+    if sampler is not None:
+        sampler.start()
+    results, elapsed = asyncio.run(run_load(args))
+    if sampler is not None:
+        sampler.stop()
+    report = build_report(results, elapsed, sampler.summary() if sampler is not None else None)
+    print(format_report(report))
+    if args.output is not None:
+        save_report(report, args.output)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='websocket load generator for the chat room')
+    add_arguments(parser)
+    parser.add_argument('--server-pid', type=int, default=None, help='sample CPU / RSS of this process')
+    args = parser.parse_args()
+    run(args, args.server_pid)
+
+
+if __name__ == '__main__':
+    main()
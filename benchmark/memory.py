@@ -0,0 +1,116 @@
+"""
+memory held by the conversation contexts of many users, as the former dicts and as Message
+
+    python -m benchmark.memory --users 2000 --turns 10
+"""
+import gc
+import os
+import json
+import random
+import argparse
+import tracemalloc
+from typing import Callable, Dict, List
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from chatgpt_api import Message, SYSTEM, USER, ASSISTANT, shared_message
+from chatroom.context_store import dump_context, load_context
+from config.config_en import Args
+from .micro import make_text
+
+
+def read_prompt(path: str) -> str:
+    with open(path, 'r') as f:     # a new string every time, as get_user_context used to get
+        return ''.join(f.readlines())
+
+
+def dict_context(user: str, prompt_path: str, turns: List[str]) -> List[dict]:
+    context = [
+        {'role': 'system', 'content': read_prompt(prompt_path)},
+        {'role': 'system', 'content': f'user: {user}'},
+    ]
+    for i, text in enumerate(turns):
+        context.append({'role': 'user' if i % 2 == 0 else 'assistant', 'content': text})
+    return context
+
+
+def message_context(user: str, prompt_path: str, turns: List[str]) -> List[Message]:
+    context = [
+        shared_message(SYSTEM, read_prompt(prompt_path)),
+        Message(SYSTEM, f'user: {user}'),
+    ]
+    for i, text in enumerate(turns):
+        context.append(Message(USER if i % 2 == 0 else ASSISTANT, text, n_tokens=len(text) // 4))
+    return context
+
+
+def restored_dict_context(user: str, prompt_path: str, turns: List[str]) -> List[dict]:
+    """
+    as read back from redis before, every role a string of its own
+    """
+    blob = dump_context(message_context(user, prompt_path, turns))
+    pairs = orjson.loads(blob) if orjson is not None else json.loads(blob)
+    return [{'role': role, 'content': content} for role, content in pairs]
+
+
+def restored_message_context(user: str, prompt_path: str, turns: List[str]) -> List[Message]:
+    return load_context(dump_context(message_context(user, prompt_path, turns)))
+
+
+def measure(build: Callable[[str, str, List[str]], list], n_users: int, n_turns: int, words_per_turn: int,
+            prompt_path: str) -> int:
+    """
+    bytes allocated by the contexts of `n_users`, message texts included
+    """
+    rng = random.Random(0)
+    turns = [[make_text(words_per_turn, rng) for _ in range(n_turns)] for _ in range(n_users)]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    # texts are copied so that each layout allocates its own, like contexts built from the network would
+    contexts = [build(f'user{i}', prompt_path, [''.join([text[:1], text[1:]]) for text in turns[i]])
+                for i in range(n_users)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del contexts
+    return after - before
+
+
+def run(n_users: int, n_turns: int, words_per_turn: int, prompt_path: str) -> Dict[str, Dict[str, float]]:
+    layouts = [
+        ('dict', dict_context),
+        ('message', message_context),
+        ('dict.restored', restored_dict_context),
+        ('message.restored', restored_message_context),
+    ]
+    results = {}
+    for name, build in layouts:
+        n_bytes = measure(build, n_users, n_turns, words_per_turn, prompt_path)
+        results[name] = {'bytes': n_bytes, 'bytes_per_user': n_bytes / n_users}
+        print(f"{name:<20} {n_bytes / 1024 / 1024:>10.2f} MiB {n_bytes / n_users:>10.0f} B/user")
+    for name in ['', '.restored']:
+        ratio = results[f'message{name}']['bytes'] / results[f'dict{name}']['bytes']
+        print(f"message{name} / dict{name}: {ratio:.2f}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='memory of the user contexts, dicts against Message')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--turns', type=int, default=10, help='messages per context besides the system prompts')
+    parser.add_argument('--words', type=int, default=40, help='words per message')
+    parser.add_argument('--prompt', default=os.path.join(Args.PROMPTS_DIR, 'chat-agent.txt'))
+    parser.add_argument('--output', default=None, help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = run(args.users, args.turns, args.words, args.prompt)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+micro-benchmarks of the per-turn hot paths, compared against a stored baseline
+
+    python -m benchmark.micro --save-baseline            # on the reference commit
+    python -m benchmark.micro                            # later on, exits with 1 on regressions
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+from typing import Callable, Dict, List, Optional
+
+from chatgpt_api import ChatGPT, Message, SYSTEM, USER, ASSISTANT
+from chatroom import create_response, encode_frame
+from config.config_en import Args
+from .fake_openai import WORDS
+
+
+CONTEXT_SIZES = [4, 16, 64, 256, 1024, 4096]
+TEXT_SIZES = [16, 256, 4096]     # words
+
+
+def make_text(n_words: int, rng: random.Random) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(n_words))
+
+
+def make_context(n_messages: int, rng: random.Random, words_per_message: int = 40) -> List[Message]:
+    context = [
+        Message(SYSTEM, 'You are a helpful assistant.'),
+        Message(SYSTEM, 'user: bench'),
+    ]
+    for i in range(n_messages - len(context)):
+        role = USER if i % 2 == 0 else ASSISTANT
+        context.append(Message(role, f'{i} ' + make_text(words_per_message, rng)))
+    return context[:n_messages]
+
+
+def forget_counts(chatgpt: ChatGPT, context: List[Message]):
+    chatgpt.token_cache.clear()
+    for message in context:
+        message.n_tokens = None
+
+
+def measure(function: Callable[[], object],
+            *,
+            setup: Optional[Callable[[], None]] = None,
+            repeat: int = 7,
+            min_time: float = 0.05,
+            ) -> Dict[str, float]:
+    """
+    time `function` in batches big enough to last `min_time`, `setup` runs before every call, untimed
+    returns per-call microseconds, the median and the minimum over `repeat` batches
+    """
+    n_calls = 1
+    while True:     # calibrate the batch size
+        elapsed = _run_batch(function, setup, n_calls)
+        if elapsed >= min_time or n_calls >= 1 << 20:
+            break
+        n_calls *= 2
+    samples = [_run_batch(function, setup, n_calls) / n_calls * 1e6 for _ in range(repeat)]
+    return {'median_us': statistics.median(samples), 'min_us': min(samples), 'calls': n_calls}
+
+
+def _run_batch(function, setup, n_calls: int) -> float:
+    elapsed = 0.
+    for _ in range(n_calls):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        elapsed += time.perf_counter() - start
+    return elapsed
+
+
+def build_chatgpt() -> ChatGPT:
+    chatgpt = ChatGPT(api_key='sk-benchmark', api_org='org-benchmark', prompts_dir=Args.PROMPTS_DIR,
+                      tokenizer_dir=Args.TOKENIZER_DIR)
+    chatgpt.__send_message__ = lambda context: 'summary of the earlier conversation'    # no network
+    return chatgpt
+
+
+def run_benchmarks(quick: bool = False) -> Dict[str, Dict[str, float]]:
+    rng = random.Random(0)
+    chatgpt = build_chatgpt()
+    repeat = 3 if quick else 7
+    min_time = 0.01 if quick else 0.05
+    results = {}
+
+    def bench(name: str, function, setup=None):
+        results[name] = measure(function, setup=setup, repeat=repeat, min_time=min_time)
+        print(f"{name:<40} {results[name]['median_us']:>12.1f} us")
+
+    for n_words in TEXT_SIZES:
+        text = make_text(n_words, rng)
+        bench(f'encode_tokens[{n_words} words]', lambda: chatgpt.encode_tokens(text))
+
+    for n_messages in CONTEXT_SIZES:
+        context = make_context(n_messages, rng)
+        bench(f'count_context_tokens.cold[{n_messages}]', lambda: chatgpt.count_context_tokens(context),
+              setup=lambda: forget_counts(chatgpt, context))
+        chatgpt.count_context_tokens(context)
+        bench(f'count_context_tokens.warm[{n_messages}]', lambda: chatgpt.count_context_tokens(context))
+
+    for n_messages in CONTEXT_SIZES:
+        context = make_context(n_messages, rng)
+        chatgpt.count_context_tokens(context)
+        # as many summary rounds as it takes, a long context is summarized a budget-sized head at a time
+        bench(f'consolidate_context[{n_messages}]',
+              lambda: chatgpt.consolidate_context(list(context), max_try=n_messages))
+
+    bench('get_prompt[chat-agent.txt]', lambda: chatgpt.get_prompt('chat-agent.txt'))
+
+    delta = make_text(4, rng)
+    reply = make_text(300, rng)
+    bench('create_response+encode_frame[delta]',
+          lambda: encode_frame(create_response(delta, receiver='bench', complete=False)))
+    bench('create_response+encode_frame[reply]',
+          lambda: encode_frame(create_response(reply, time_str='2023-03-20 12:00:00', sender='ChatGPT',
+                                               receiver='bench', color=Args.CHATGPT_TEXT_COLOR)))
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """
+    names of the benchmarks slower than the baseline by more than `tolerance` (relative, on the median)
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['median_us'] / baseline[name]['median_us']
+        flag = ''
+        if ratio > 1. + tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:<40} {baseline[name]['median_us']:>12.1f} -> {result['median_us']:>12.1f} us  x{ratio:.2f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='micro-benchmarks of the chatgpt_api hot paths')
+    parser.add_argument('--baseline', default=os.path.join(Args.CACHE_DIR, 'benchmark', 'micro_baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--output', default=None, help='write the results as JSON to this file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown reported as a regression')
+    parser.add_argument('--quick', action='store_true', help='fewer and shorter repetitions')
+    args = parser.parse_args()
+
+    results = run_benchmarks(quick=args.quick)
+    document = {'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': sys.version.split()[0],
+                'results': results}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(document, f, indent=2)
+        print(f'baseline saved to {args.baseline}')
+        return
+    if not os.path.exists(args.baseline):
+        print(f'no baseline at {args.baseline}, run with --save-baseline first')
+        return
+
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)['results']
+    print()
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f'{len(regressions)} regression(s) beyond {args.tolerance:.0%}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+summaries of a load run: throughput, latency percentiles and server CPU / RSS
+"""
+import json
+import time
+import threading
+from typing import Dict, List, Optional, Sequence
+
+import psutil
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """
+    linear interpolation between closest ranks, q in [0, 100]
+    """
+    if len(values) == 0:
+        return float('nan')
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100.
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def describe(values: Sequence[float]) -> Dict[str, float]:
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) if values else float('nan'),
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else float('nan'),
+    }
+
+
+class ResourceSampler(object):
+    """
+    samples CPU and RSS of a process and its children in a background thread
+    """
+
+    def __init__(self, pid: int, interval: float = 0.5):
+        self.process = psutil.Process(pid)
+        self.interval: float = interval
+        self.cpu_percent: List[float] = []
+        self.rss_bytes: List[int] = []
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def processes(self) -> list:
+        return [self.process] + self.process.children(recursive=True)
+
+    def start(self):
+        for process in self.processes():
+            process.cpu_percent(None)   # primes the counters, the first call always returns 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            cpu, rss = 0., 0
+            for process in self.processes():
+                try:
+                    cpu += process.cpu_percent(None)
+                    rss += process.memory_info().rss
+                except psutil.Error:
+                    continue
+            self.cpu_percent.append(cpu)
+            self.rss_bytes.append(rss)
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            'cpu_percent_mean': sum(self.cpu_percent) / len(self.cpu_percent) if self.cpu_percent else float('nan'),
+            'cpu_percent_max': max(self.cpu_percent) if self.cpu_percent else float('nan'),
+            'rss_mb_max': max(self.rss_bytes) / 2 ** 20 if self.rss_bytes else float('nan'),
+        }
+
+
+def build_report(results: List[dict], elapsed: float, resources: Optional[Dict[str, float]] = None) -> dict:
+    """
+    `results` holds one dict per request, see benchmark.load.Request.result
+    """
+    completed = [result for result in results if result['status'] == 'ok']
+    n_chars = sum(result['n_chars'] for result in completed)
+    report = {
+        'requests': len(results),
+        'completed': len(completed),
+        'failed': sum(1 for result in results if result['status'] == 'error'),
+        'timed_out': sum(1 for result in results if result['status'] == 'timeout'),
+        'notices': sum(result['n_notices'] for result in results),
+        'elapsed_seconds': elapsed,
+        'replies_per_second': len(completed) / elapsed if elapsed > 0 else float('nan'),
+        'chars_per_second': n_chars / elapsed if elapsed > 0 else float('nan'),
+        'first_delta_seconds': describe([result['first_delta'] for result in completed
+                                         if result['first_delta'] is not None]),
+        'latency_seconds': describe([result['latency'] for result in completed]),
+        'frames_received': sum(result['n_frames'] for result in results),
+    }
+    if resources is not None:
+        report['server'] = resources
+    return report
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        f"requests            {report['requests']}  completed {report['completed']}  failed {report['failed']}  "
+        f"timed out {report['timed_out']}  notices {report['notices']}",
+        f"throughput          {report['replies_per_second']:.2f} replies/s  {report['chars_per_second']:.0f} chars/s  "
+        f"over {report['elapsed_seconds']:.1f}s",
+    ]
+    for name in ['first_delta_seconds', 'latency_seconds']:
+        stats = report[name]
+        lines.append(f"{name:<20}p50 {stats['p50']:.3f}  p90 {stats['p90']:.3f}  p99 {stats['p99']:.3f}  "
+                     f"max {stats['max']:.3f}  (n={stats['count']})")
+    lines.append(f"frames              {report['frames_received']} received by all clients")
+    if 'server' in report:
+        server = report['server']
+        lines.append(f"server              cpu mean {server['cpu_percent_mean']:.1f}%  "
+                     f"max {server['cpu_percent_max']:.1f}%  rss max {server['rss_mb_max']:.1f} MB")
+    return '\n'.join(lines)
+
+
+def save_report(report: dict, path: str):
+    report = dict(report, timestamp=time.strftime('%Y-%m-%d %H:%M:%S'))
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,37 @@
+"""
+runs the chat room server against a given upstream, without editing the config
+
+    python -m benchmark.serve --upstream http://127.0.0.1:8765/v1 --port 8080
+"""
+import os
+import argparse
+
+import uvicorn
+
+
+def main():
+    parser = argparse.ArgumentParser(description='chat room server pointed at a (fake) upstream')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--upstream', default='http://127.0.0.1:8765/v1', help='chat completions base url')
+    parser.add_argument('--keep-rate-limits', action='store_true', help='keep the per-user rate limits of the config')
+    parser.add_argument('--no-cache', action='store_true', help='disable the response cache and single flight')
+    args = parser.parse_args()
+
+    from config.config_en import Args
+    Args.OPENAI_API_BASE = args.upstream
+    if not args.keep_rate_limits:
+        Args.RATE_LIMIT_REQUESTS_PER_MIN = 0.
+        Args.RATE_LIMIT_TOKENS_PER_MIN = 0.
+    if args.no_cache:
+        Args.RESPONSE_CACHE = False
+        Args.SINGLE_FLIGHT = False
+    os.environ.setdefault(Args.ENV_API_KEY, 'sk-benchmark')
+    os.environ.setdefault(Args.ENV_ORG_ID, 'org-benchmark')
+
+    import main as server
+    uvicorn.run(server.app, host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
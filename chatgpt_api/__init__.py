@@ -1,8 +1,22 @@
 from .chatgpt import ChatGPT, ChatGPTDebug
+from .response_cache import ResponseCache
+from .message import Message, SYSTEM, USER, ASSISTANT, shared_message, find_shared
+from .tokenizer import load_encoding, check_tokenizer_assets
+from .exception import TokenizerAssetError
 from .utils import time_now_str
 
 __all__ = [
     'ChatGPT',
     'ChatGPTDebug',
+    'ResponseCache',
+    'Message',
+    'SYSTEM',
+    'USER',
+    'ASSISTANT',
+    'shared_message',
+    'find_shared',
+    'load_encoding',
+    'check_tokenizer_assets',
+    'TokenizerAssetError',
     'time_now_str'
 ]
@@ -1,13 +1,28 @@
 import os
 import time
-import traceback
-from typing import Literal
-
+import json
+import asyncio
+import logging
+from bisect import bisect_right
+from itertools import accumulate
+from typing import Callable, List, Literal, Optional, Tuple
+
+import httpx
 import openai
-import tiktoken
+from .sse import SSEDecoder
+from .response_cache import ResponseCache
+from .single_flight import SingleFlight
+from .tokenizer import load_encoding
+from .token_counter import TokenCounter
+from .prompts import PromptCache
+from .message import Message, SYSTEM, USER, ASSISTANT, shared_message, to_messages, wire_format
+from .exception import UpstreamError
 from .utils import warn
 
 
+logger = logging.getLogger(__name__)
+
+
 class ChatGPT(object):
     MAX_TOKENS: int = 4096
     REPLY_COST: int = 2   # every reply is primed with <im_start>assistant, minus 2
@@ -18,30 +33,81 @@ class ChatGPT(object):
                  api_key: str,
                  api_org: str,
                  prompts_dir: str = './prompts',
+                 prompt_check_interval: float = 2.,
                  model_name: Literal['gpt-3.5-turbo', 'gpt-3.5-turbo-0301'] = 'gpt-3.5-turbo-0301',
                  temperature: float = 1.,
                  min_reply_tokens: int = 800,
                  network_err_text: str = '[encountering unknown network error]',
+                 api_base: str = 'https://api.openai.com/v1',
+                 http2: bool = False,
+                 max_connections: int = 100,
+                 token_cache_size: int = 4096,
+                 tokenizer_dir: Optional[str] = None,
+                 tokenizer_threads: int = 1,
+                 tokenizer_processes: int = 0,
+                 tokenizer_process_threshold: int = 100000,
+                 soft_watermark: float = 0.75,
+                 consolidate_mode: Literal['summarize', 'sliding_window'] = 'summarize',
+                 response_cache: Optional[ResponseCache] = None,
+                 cache_nondeterministic: bool = False,
+                 cache_key_filter: Optional[Callable[[Message], bool]] = None,
+                 replay_chars_per_second: float = 400.,
+                 single_flight: bool = True,
+                 metrics=None,
                  ):
         """
 
         :param api_key:
         :param api_org:
         :param prompts_dir:
+        :param prompt_check_interval: seconds between checks of the prompt files for changes, see PromptCache
         :param model_name:
         :param temperature:
+        :param api_base:        base url of the chat completions endpoint, used by the async client
+        :param http2:           use HTTP/2 for the async client (requires the 'h2' package)
+        :param max_connections: size of the async client's keep-alive connection pool
+        :param token_cache_size: number of distinct message strings whose token count is memorized
+        :param tokenizer_dir:   prebuilt tokenizer files, loaded without network access, see chatgpt_api.tokenizer
+        :param tokenizer_threads: threads of the executor the async token counting runs on
+        :param tokenizer_processes: process pool for very large pastes in async token counting, 0 for none
+        :param tokenizer_process_threshold: length in characters from which a string is counted in the process pool
+        :param soft_watermark:  fraction of the token budget above which a context is worth compacting ahead of time
+        :param consolidate_mode: 'summarize' aged messages with an extra API call,
+                                 or 'sliding_window' which simply drops the oldest non-system messages
+        :param response_cache:  replies are cached and replayed when given, only with temperature == 0 by default
+        :param cache_nondeterministic: cache with any temperature as well
+        :param cache_key_filter: predicate on messages, those rejected take no part in the cache key and are not
+                                 sent upstream either, so that a shared reply cannot depend on them
+        :param replay_chars_per_second: speed at which cached replies are streamed, 0 for all at once
+        :param single_flight:   requests identical to one in flight (same key as the cache) attach to its stream
+        :param metrics:         optional hook with observe_tokenize(seconds), observe_consolidation(kind, seconds),
+                                observe_first_token(seconds), observe_completion(seconds, n_tokens, streaming_seconds)
+                                and count_upstream_error(error_type), e.g. chatroom.ChatMetrics
         """
         assert model_name in ['gpt-3.5-turbo', 'gpt-3.5-turbo-0301'], \
             f"'model_name' must be one of ['gpt-3.5-turbo', 'gpt-3.5-turbo-0301'] but received '{model_name}'"
         self.model_name = model_name
+        assert consolidate_mode in ['summarize', 'sliding_window'], \
+            f"'consolidate_mode' must be one of ['summarize', 'sliding_window'] but received '{consolidate_mode}'"
+        self.consolidate_mode = consolidate_mode
         assert os.path.exists(prompts_dir), f"prompts_dir '{prompts_dir}' is not found!"
         self.prompts_dir: str = prompts_dir
         self.temperature: float = temperature  # 0.0 ~ 1.0
         self.min_reply_tokens = min_reply_tokens
-        self.max_tokens: int = self.MAX_TOKENS - self.REPLY_COST - self.min_reply_tokens
-
-        self.tokenizer = self.load_tokenizer(self.model_name)
-        self.prompts_dict = self.load_prompts_dict()
+        self.max_tokens: int = self.MAX_TOKENS - self.REPLY_COST - self.min_reply_tokens  # hard watermark
+        self.soft_max_tokens: int = int(self.max_tokens * soft_watermark)
+
+        self.token_counter = TokenCounter(
+            self.model_name,
+            cache_dir=tokenizer_dir,
+            cache_size=token_cache_size,
+            num_threads=tokenizer_threads,
+            num_processes=tokenizer_processes,
+            process_threshold=tokenizer_process_threshold,
+            metrics=metrics,
+        )
+        self.tokenizer = self.token_counter.encoding
+        self.token_cache = self.token_counter.cache     # digest of the text -> number of tokens
         self.network_err_text = network_err_text
 
         if api_key is not None:
@@ -49,29 +115,41 @@ class ChatGPT(object):
         if api_org is not None:
             openai.organization = api_org
 
-    def load_prompts_dict(self):
-        prompt_fnames = os.listdir(self.prompts_dir)
-        if '.DS_Store' in prompt_fnames:
-            prompt_fnames.remove('.DS_Store')
-
-        prompts_dict = {}
-        for fname in prompt_fnames:
-            prompts_dict[fname] = os.path.join(self.prompts_dir, fname)
-        return prompts_dict
-
-    def get_prompt(self, prompt: str):
-        prompts_dict = self.prompts_dict
-        if prompt in prompts_dict:
-            with open(prompts_dict[prompt], 'r') as f:
-                return ''.join(f.readlines())
-        else:
-            self.prompts_dict = prompts_dict = self.load_prompts_dict()
-            if prompt in prompts_dict:
-                with open(prompts_dict[prompt], 'r') as f:
-                    return ''.join(f.readlines())
-            else:
-                warn(f"prompt file '{prompt}' under directory '{self.prompts_dir}'")
-                return ''
+        self.api_key: Optional[str] = api_key
+        self.api_org: Optional[str] = api_org
+        self.api_base: str = api_base.rstrip('/')
+        self.http2: bool = http2
+        self.max_connections: int = max_connections
+        self.http_client: Optional[httpx.AsyncClient] = None
+
+        self.response_cache: Optional[ResponseCache] = response_cache
+        self.cache_nondeterministic: bool = cache_nondeterministic
+        self.cache_key_filter: Optional[Callable[[Message], bool]] = cache_key_filter
+        self.replay_chars_per_second: float = replay_chars_per_second
+        self.single_flight: Optional[SingleFlight] = SingleFlight() if single_flight else None
+        self.metrics = metrics
+        # read once, token counts taken on load so system prompts cost nothing per turn
+        self.prompts = PromptCache(prompts_dir, check_interval=prompt_check_interval,
+                                   on_load=self.count_context_tokens)
+
+    def get_prompt(self, prompt: str) -> str:
+        return self.get_prompt_message(prompt).content
+
+    def get_prompt_message(self, prompt: str) -> Message:
+        """
+        the shared system message of a prompt file, its tokens already counted
+        """
+        entry = self.prompts.get_entry(prompt)
+        if entry is None:
+            warn(f"prompt file '{prompt}' under directory '{self.prompts_dir}'")
+            return shared_message(SYSTEM, '')
+        return entry.message
+
+    def reload_prompts(self) -> List[str]:
+        """
+        reread every prompt file now, returns their names
+        """
+        return self.prompts.reload()
 
     def launch_chatgpt(self):
         model_name = self.model_name
@@ -85,24 +163,32 @@ class ChatGPT(object):
                     status = True
                     break
         except Exception:
-            traceback.print_exc()
+            logger.exception('failed to list the models')
         return status
 
     @staticmethod
-    def load_tokenizer(model_name):
-        try:
-            tokenizer = tiktoken.encoding_for_model(model_name)
-        except KeyError:
-            tokenizer = tiktoken.get_encoding("cl100k_base")
-        return tokenizer
+    def load_tokenizer(model_name, cache_dir: Optional[str] = None):
+        return load_encoding(model_name, cache_dir)
 
     def encode_tokens(self, text: str):
         tokens = self.tokenizer.encode(text)
         return tokens
 
+    async def encode_tokens_async(self, text: str):
+        return await self.token_counter.encode_async(text)
+
     def decode_tokens(self, tokens):
         return self.tokenizer.decode(tokens)
 
+    def count_tokens(self, text: str) -> int:
+        """
+        memorized, each distinct string is encoded once while it stays in the cache
+        """
+        return self.token_counter.count(text)
+
+    async def count_tokens_async(self, text: str) -> int:
+        return await self.token_counter.count_async(text)
+
     def count_context_tokens(self, context: list):
         """
         reference
@@ -111,18 +197,36 @@ class ChatGPT(object):
 
         See https://github.com/openai/openai-python/blob/main/chatml.md for information on how
         messages are converted to tokens.
+
+        counts are kept on the messages, those not counted yet are encoded in one batch; dicts are counted too,
+        through a Message copy
+        """
+        context = to_messages(context)
+        uncounted = [message for message in context if message.n_tokens is None]
+        if uncounted:
+            self.set_message_tokens(uncounted, self.token_counter.count_many(self.message_texts(uncounted)))
+        return [message.n_tokens for message in context]
+
+    async def count_context_tokens_async(self, context: list):
+        """
+        count_context_tokens with the encoding done off the event loop
         """
+        context = to_messages(context)
+        uncounted = [message for message in context if message.n_tokens is None]
+        if uncounted:
+            counts = await self.token_counter.count_many_async(self.message_texts(uncounted))
+            self.set_message_tokens(uncounted, counts)
+        return [message.n_tokens for message in context]
+
+    @staticmethod
+    def message_texts(messages: List[Message]) -> List[str]:
+        return [text for message in messages for text in (message.role, message.content)]
+
+    def set_message_tokens(self, messages: List[Message], counts: List[int]):
         min_token_per_msg = self.MIN_TOKEN_PER_MSG
-        num_tokens_list = []
-        for message in context:
-            num_tokens = min_token_per_msg  # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            for key, value in message.items():
-                num_tokens += len(self.tokenizer.encode(value))
-                if key == "name":  # if there's a name, the role is omitted
-                    num_tokens += -1  # role is always required and always 1 token
-            num_tokens_list.append(num_tokens)
-        # num_tokens_list.append(self.REPLY_COST)  # every reply is primed with <im_start>assistant
-        return num_tokens_list
+        for i, message in enumerate(messages):
+            # every message follows <im_start>{role/name}\n{content}<im_end>\n
+            message.n_tokens = min_token_per_msg + counts[2 * i] + counts[2 * i + 1]
 
     def __send_message_stream__(self, context: list):
         """
@@ -148,7 +252,7 @@ class ChatGPT(object):
                 stream=True,
                 temperature=temperature,  # 0.0 ~ 1.0
                 # max_tokens=4096,  # <= 4096
-                messages=context
+                messages=wire_format(context)
             )
 
             for res in iterator:
@@ -162,17 +266,120 @@ class ChatGPT(object):
                 if status:
                     break
 
-        except Exception as err:
-            traceback.print_exc()
-            print('exception text')
-            print(str(err))
-            print(f'context token size: {self.count_context_tokens(context)}')
+        except Exception:
+            n_tokens = sum(self.count_context_tokens(context))
+            logger.exception('upstream request failed', extra={'context_tokens': n_tokens})
             content = self.network_err_text
             status = True
             yield content, status
         finally:
             pass
 
+    def get_http_client(self) -> httpx.AsyncClient:
+        """
+        pooled keep-alive client shared by all async requests, created on first use inside the running loop
+        """
+        if self.http_client is None or self.http_client.is_closed:
+            headers = {}
+            if self.api_key:
+                headers['Authorization'] = f'Bearer {self.api_key}'
+            if self.api_org:
+                headers['OpenAI-Organization'] = self.api_org
+            self.http_client = httpx.AsyncClient(
+                base_url=self.api_base,
+                headers=headers,
+                http2=self.http2,
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+                timeout=httpx.Timeout(60., connect=10.),
+            )
+        return self.http_client
+
+    async def warm_up(self, timeout: float = 5.):
+        """
+        open a pooled connection ahead of the first request, failures are left for that request to report
+        """
+        # noinspection PyBroadException
+        try:
+            await self.get_http_client().get('/models', timeout=timeout)
+        except Exception:
+            logger.warning('upstream warm-up failed', exc_info=True)
+
+    async def aclose(self):
+        if self.http_client is not None:
+            await self.http_client.aclose()
+            self.http_client = None
+        self.token_counter.close()
+
+    async def __send_message_stream_async__(self, context: list):
+        """
+        async counterpart of __send_message_stream__, parses the SSE body incrementally
+
+        Yield:
+             content: string
+             status:  bool, True upon final return
+        """
+
+        # noinspection PyBroadException
+        try:
+            payload = {
+                'model': self.model_name,
+                'stream': True,
+                'temperature': self.temperature,  # 0.0 ~ 1.0
+                'messages': wire_format(context),
+            }
+            client = self.get_http_client()
+            async with client.stream('POST', '/chat/completions', json=payload) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    raise UpstreamError(f'status {response.status_code}: {response.text}', response.status_code)
+
+                decoder = SSEDecoder()
+                async for chunk in response.aiter_bytes():
+                    for data in decoder.feed(chunk):
+                        if data == '[DONE]':
+                            return
+                        choice = json.loads(data)['choices'][0]
+                        delta = choice.get('delta', {})
+                        status = choice.get('finish_reason') is not None
+                        if 'content' in delta:
+                            yield delta['content'], status
+                        if status:
+                            return
+
+        except Exception as err:
+            n_tokens = sum(await self.count_context_tokens_async(context))
+            logger.exception('upstream request failed', extra={'context_tokens': n_tokens})
+            self.count_upstream_error(err)
+            content = self.network_err_text
+            status = True
+            yield content, status
+
+    def count_upstream_error(self, err: Exception):
+        if self.metrics is None:
+            return
+        if isinstance(err, UpstreamError) and err.status_code is not None:
+            self.metrics.count_upstream_error(f'http_{err.status_code}')
+        else:
+            self.metrics.count_upstream_error(type(err).__name__)
+
+    async def __send_message_async__(self, context: list):
+        payload = {
+            'model': self.model_name,
+            'stream': False,
+            'temperature': self.temperature,  # 0.0 ~ 1.0
+            'messages': wire_format(context),
+        }
+        try:
+            response = await self.get_http_client().post('/chat/completions', json=payload)
+            if response.status_code != 200:
+                raise UpstreamError(f'status {response.status_code}: {response.text}', response.status_code)
+        except Exception as err:
+            self.count_upstream_error(err)
+            raise
+        content: str = response.json()['choices'][0]['message']['content']
+        return content
+
     def __send_message__(self, context: list):
         model_name = self.model_name
         temperature = self.temperature
@@ -182,7 +389,7 @@ class ChatGPT(object):
             stream=False,
             temperature=temperature,  # 0.0 ~ 1.0
             # max_tokens=4096,  # <= 4096
-            messages=context
+            messages=wire_format(context)
         )
         content: str = res.choices[0].message.content
         return content
@@ -190,13 +397,13 @@ class ChatGPT(object):
     @staticmethod
     def create_context(text: str):
         context = [
-            {"role": "user", "content": str(text)},
+            Message(USER, str(text)),
         ]
         return context
 
     @staticmethod
     def update_context(context: list, content: str):
-        context.append({'role': 'assistant', 'content': str(content)})
+        context.append(Message(ASSISTANT, str(content)))
         return context
 
     def consolidate_context(self,
@@ -209,41 +416,186 @@ class ChatGPT(object):
         if sum(num_tokens_list) < max_tokens:
             return context
 
+        start = time.perf_counter()
+        try:
+            return self._consolidate_context(context, num_tokens_list, keep_left, keep_right, max_try)
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe_consolidation('inline', time.perf_counter() - start)
+
+    def _consolidate_context(self, context: list, num_tokens_list: List[int], keep_left: int, keep_right: int,
+                             max_try: int):
+        max_tokens: int = self.max_tokens
+        if self.consolidate_mode == 'sliding_window':
+            return self.slide_context(context, num_tokens_list, keep_right=keep_right)
+
         '''
         summarize aged messages
         '''
-        summary_request: str = self.get_prompt('context-summarizer.txt')
-        summary_req_context: list = [{'role': 'system', 'content': summary_request}]
+        summary_req_context: list = [self.get_prompt_message('context-summarizer.txt')]
         summary_req_n_tokens: int = sum(self.count_context_tokens(summary_req_context))
         try_i = 1
         while sum(num_tokens_list) >= max_tokens:
             if try_i > max_try:
-                raise ValueError(f"""\
+                raise self.max_try_error(max_try)
+
+            ''' [1] largest head of the context that can be summarized, keeping the last `keep_right` messages '''
+            split = self.find_split(num_tokens_list, max_tokens - summary_req_n_tokens, len(context) - keep_right)
+            ''' [2] summarize '''
+            summarized_content = self.__send_message__(context[:split] + summary_req_context)
+            summarized_context = [Message(SYSTEM, summarized_content)]
+            ''' [3] putting back the kept messages around the summary '''
+            context = context[:min(keep_left, split)] + summarized_context + context[split:]
+            num_tokens_list = self.count_context_tokens(context)
+            try_i += 1
+        return context
+
+    async def consolidate_context_async(self,
+                                        context: list,
+                                        keep_left: int = 2,
+                                        keep_right: int = 1,
+                                        max_try: int = 3):
+        """
+        consolidate_context through the pooled async client, the configured api_base and its timeouts
+        """
+        max_tokens: int = self.max_tokens
+        num_tokens_list = await self.count_context_tokens_async(context)
+        if sum(num_tokens_list) < max_tokens:
+            return context
+
+        start = time.perf_counter()
+        try:
+            if self.consolidate_mode == 'sliding_window':
+                return self.slide_context(context, num_tokens_list, keep_right=keep_right)
+
+            summary_req_context: list = [self.get_prompt_message('context-summarizer.txt')]
+            summary_req_n_tokens: int = sum(await self.count_context_tokens_async(summary_req_context))
+            try_i = 1
+            while sum(num_tokens_list) >= max_tokens:
+                if try_i > max_try:
+                    raise self.max_try_error(max_try)
+                split = self.find_split(num_tokens_list, max_tokens - summary_req_n_tokens, len(context) - keep_right)
+                summarized_content = await self.__send_message_async__(context[:split] + summary_req_context)
+                context = context[:min(keep_left, split)] + [Message(SYSTEM, summarized_content)] + context[split:]
+                num_tokens_list = await self.count_context_tokens_async(context)
+                try_i += 1
+            return context
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe_consolidation('inline', time.perf_counter() - start)
+
+    @staticmethod
+    def max_try_error(max_try: int) -> ValueError:
+        return ValueError(f"""\
 Hitting max_try({max_try}) while trying to consolidate context.
 Consider changing the parameters "keep_left" and "keep_right",
 as well as reducing length of the prompts.""")
 
-            left_queue: list = context
-            left_tokens_list = num_tokens_list
-            right_queue: list = []
-            right_tokens_list = []
-            ''' [1] save messages that are not to be altered'''
-            for _ in range(keep_right):
-                right_queue.insert(0, left_queue.pop(-1))
-                right_tokens_list.insert(0, left_tokens_list.pop(-1))
-            ''' [2] keep moving messages from left to right until a summary request can be executed '''
-            while sum(left_tokens_list) + summary_req_n_tokens > max_tokens:
-                right_queue.insert(0, left_queue.pop(-1))
-                right_tokens_list.insert(0, left_tokens_list.pop(-1))
-            ''' [3] summarize '''
-            context = left_queue + summary_req_context
-            summarized_content = self.__send_message__(context)
-            summarized_context = [{'role': 'system', 'content': summarized_content}]
-            ''' [4] putting back context messages from the queues '''
-            context = left_queue[:keep_left] + summarized_context + right_queue
-            num_tokens_list = self.count_context_tokens(context)
-            try_i += 1
-        return context
+    @staticmethod
+    def find_split(num_tokens_list: List[int], budget: int, upper: int) -> int:
+        """
+        largest split <= upper such that sum(num_tokens_list[:split]) <= budget, by binary search over prefix sums
+        """
+        prefix_sums = list(accumulate(num_tokens_list[:upper], initial=0))
+        return bisect_right(prefix_sums, budget) - 1
+
+    def slide_context(self, context: list, num_tokens_list: List[int], keep_right: int = 1):
+        """
+        drop the oldest non-system messages until the context fits, the last `keep_right` messages are kept
+        """
+        max_tokens: int = self.max_tokens
+        n_tokens = sum(num_tokens_list)
+        droppable = len(context) - keep_right
+        kept = []
+        for i, message in enumerate(context):
+            if n_tokens >= max_tokens and i < droppable and message.role != SYSTEM:
+                n_tokens -= num_tokens_list[i]
+                continue
+            kept.append(message)
+        if n_tokens >= max_tokens:
+            raise ValueError(f"""\
+Context of {n_tokens} tokens does not fit in {max_tokens} tokens after dropping all droppable messages.
+Consider changing the parameter "keep_right", as well as reducing length of the prompts.""")
+        return kept
+
+    async def needs_compaction(self, context: list) -> bool:
+        if self.consolidate_mode == 'sliding_window':   # trimming is cheap enough to stay inline
+            return False
+        return sum(await self.count_context_tokens_async(context)) >= self.soft_max_tokens
+
+    async def exceeds_budget(self, context: list) -> bool:
+        return sum(await self.count_context_tokens_async(context)) >= self.max_tokens
+
+    async def compact_context_async(self,
+                                    context: list,
+                                    keep_left: int = 2,
+                                    keep_right: int = 1,
+                                    ) -> Optional[Tuple[list, int]]:
+        """
+        summarize context[keep_left:split] into one system message, the previous summary (if any) sits right after
+        the kept messages and is therefore folded into the new one, i.e. a rolling summary
+
+        Return:
+            compacted:  messages replacing context[:split]
+            split:      number of leading messages of `context` that `compacted` replaces
+            or None if there is nothing to summarize
+        """
+        max_tokens: int = self.max_tokens
+        num_tokens_list = await self.count_context_tokens_async(context)
+        summary_req_context: list = [self.get_prompt_message('context-summarizer.txt')]
+        summary_req_n_tokens: int = sum(await self.count_context_tokens_async(summary_req_context))
+
+        split = self.find_split(num_tokens_list, max_tokens - summary_req_n_tokens, len(context) - keep_right)
+        if split <= keep_left + 1:  # a single message gains nothing from summarizing
+            return None
+
+        start = time.perf_counter()
+        try:
+            summarized_content = await self.__send_message_async__(context[:split] + summary_req_context)
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe_consolidation('background', time.perf_counter() - start)
+        compacted = context[:keep_left] + [Message(SYSTEM, summarized_content)]
+        return compacted, split
+
+    @staticmethod
+    def apply_compaction(context: list, snapshot: list, compacted: list, split: int) -> list:
+        """
+        swap in a compaction computed from `snapshot`, provided `context` has only grown since
+        """
+        if context[:len(snapshot)] != snapshot:
+            return context
+        return compacted + context[split:]
+
+    @property
+    def cacheable(self) -> bool:
+        return self.response_cache is not None and (self.temperature == 0 or self.cache_nondeterministic)
+
+    async def replay(self, content: str, chunk_size: int = 8):
+        """
+        stream a cached reply in chunks, paced like a live one
+        """
+        chars_per_second = self.replay_chars_per_second
+        for i in range(0, len(content), chunk_size):
+            chunk = content[i:i + chunk_size]
+            yield chunk
+            if chars_per_second > 0:
+                await asyncio.sleep(len(chunk) / chars_per_second)
+
+    def prepare_context(self, *, text: str = None, context: list = None):
+        if text is None and context is None:
+            raise ValueError(f"either 'text' or 'context' needs to be provided")
+        if isinstance(context, list):
+            context = list(context)     # never appended to in place, it may be the one held by the ContextStore
+        if (text is not None) and len(text) > 0:
+            _context = self.create_context(text)
+            if (context is not None) and isinstance(context, list):
+                context += _context
+            else:
+                context = _context
+        if (context is None) or (not isinstance(context, list)):
+            raise ValueError(f"unknown context value: {context}")
+        return to_messages(context)
 
     def send_message(self,
                      *,
@@ -255,7 +607,7 @@ as well as reducing length of the prompts.""")
         Args:
 
             text:       query text
-            context:    list of dictionaries specifying {"role": "system"/"user"/"assistant", "content": strings}
+            context:    list of Message, or of dictionaries {"role": "system"/"user"/"assistant", "content": strings}
             stream:     bool
 
         Yield (if stream) or Return (if not stream):
@@ -265,16 +617,7 @@ as well as reducing length of the prompts.""")
             context:        updated context
             full_content:   str
         """
-        if text is None and context is None:
-            raise ValueError(f"either 'text' or 'context' needs to be provided")
-        if (text is not None) and len(text) > 0:
-            _context = self.create_context(text)
-            if (context is not None) and isinstance(context, list):
-                context += _context
-            else:
-                context = _context
-        if (context is None) or (not isinstance(context, list)):
-            raise ValueError(f"unknown context value: {context}")
+        context = self.prepare_context(text=text, context=context)
         context = self.consolidate_context(context, keep_right=1)
 
         '''
@@ -307,6 +650,100 @@ as well as reducing length of the prompts.""")
         else:
             return content, status, context, full_content
 
+    async def send_message_async(self,
+                                 *,
+                                 text: str = None,
+                                 context: list = None,
+                                 ):
+        """
+        streaming counterpart of send_message for use inside an event loop, network reads never block the loop
+
+            async for content, status, context, full_content in chatgpt.send_message_async(text=text):
+                ...
+
+        the context is only consolidated here when it is over budget, callers are expected to keep it compact
+        in the background with compact_context_async
+
+        Yield: same as send_message(stream=True)
+        """
+        context = self.prepare_context(text=text, context=context)
+        context = await self.consolidate_context_async(context)
+
+        '''
+        [1] send request、receive text, or replay it from the cache
+        '''
+        cache_key = None
+        if self.cacheable or self.single_flight is not None:
+            cache_key = ResponseCache.make_key(self.model_name, self.temperature, context, self.cache_key_filter)
+        cached_content = await self.response_cache.get_async(cache_key) if self.cacheable else None
+        inflight = None
+        if cached_content is None and self.single_flight is not None:
+            inflight = self.single_flight.get(cache_key)
+
+        content_list = []
+        reply_tokens = None
+        upstream = cached_content is None and inflight is None
+        if cached_content is not None:
+            async for content in self.replay(cached_content):
+                content_list.append(content)
+                yield content, False, context, None
+        elif inflight is not None:  # identical request in flight, replay what it has so far and tail it
+            async for content in inflight.follow():
+                content_list.append(content)
+                yield content, False, context, None
+            if inflight.failed:     # the leader was stopped or failed, its reply is not ours to keep
+                if content_list:
+                    content_list.append(self.network_err_text)
+                    yield self.network_err_text, False, context, None
+                else:
+                    upstream = True
+        if upstream:
+            if self.single_flight is not None:
+                inflight = self.single_flight.start(cache_key)
+            failed = False
+            completed = False
+            start = time.perf_counter()
+            first_token_time = None
+            request_context = context
+            if self.cache_key_filter is not None:
+                request_context = [message for message in context if self.cache_key_filter(message)]
+            try:
+                async for content, status in self.__send_message_stream_async__(request_context):
+                    failed = status and content == self.network_err_text
+                    if first_token_time is None and len(content) > 0 and not failed:
+                        first_token_time = time.perf_counter()
+                        if self.metrics is not None:
+                            self.metrics.observe_first_token(first_token_time - start)
+                    content_list.append(content)
+                    if inflight is not None and not failed:
+                        inflight.append(content)
+                    yield content, False, context, None
+                completed = True
+            finally:
+                if inflight is not None:
+                    # cancelled by a stop or a disconnect when not completed, followers must not take it as a reply
+                    self.single_flight.finish(cache_key, inflight, failed=failed or not completed)
+            if not failed:
+                end = time.perf_counter()
+                reply_tokens = await self.token_counter.count_uncached_async(''.join(content_list))
+                if self.metrics is not None and first_token_time is not None:
+                    self.metrics.observe_completion(end - start, reply_tokens, end - first_token_time)
+            if self.cacheable and not failed:
+                await self.response_cache.put_async(cache_key, ''.join(content_list))
+        full_content = ''.join(content_list)
+
+        '''
+        [2] update context
+        '''
+        context = self.update_context(context, full_content)
+        if reply_tokens is not None:    # counted once above, kept on the message rather than in the cache
+            context[-1].n_tokens = self.MIN_TOKEN_PER_MSG + self.count_tokens(ASSISTANT) + reply_tokens
+
+        '''
+        [3] return 
+        '''
+        yield '', True, context, full_content
+
 
 class ChatGPTDebug(ChatGPT):
     def __init__(self,
@@ -337,6 +774,9 @@ print('hello world')
 </head>
 ```'''
 
+    async def warm_up(self, timeout: float = 5.):
+        pass
+
     def send_message(self,
                      *,
                      text: str = None,
@@ -347,7 +787,7 @@ print('hello world')
         Args:
 
             text:       query text
-            context:    list of dictionaries specifying {"role": "system"/"user"/"assistant", "content": strings}
+            context:    list of Message, or of dictionaries {"role": "system"/"user"/"assistant", "content": strings}
             stream:     bool
 
         Yield (if stream) or Return (if not stream):
@@ -381,3 +821,22 @@ print('hello world')
             yield content, status, context, full_content
         else:
             return content, status, context, full_content
+
+    async def send_message_async(self,
+                                 *,
+                                 text: str = None,
+                                 context: list = None,
+                                 ):
+        reply_text = self.reply_text
+
+        '''
+        [1] send request、receive text
+        '''
+        for content in reply_text.split('\n'):
+            yield '\n' + content, False, context, None
+            await asyncio.sleep(0.5)
+
+        '''
+        [3] return 
+        '''
+        yield '', True, context, reply_text
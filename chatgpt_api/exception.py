@@ -1,3 +1,15 @@
+from typing import Optional
+
 
 class LongInputException(Exception):
     pass
+
+
+class TokenizerAssetError(Exception):
+    pass
+
+
+class UpstreamError(Exception):
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code: Optional[int] = status_code
@@ -0,0 +1,76 @@
+import sys
+import threading
+from typing import Dict, List, Optional, Tuple
+
+
+SYSTEM = sys.intern('system')
+USER = sys.intern('user')
+ASSISTANT = sys.intern('assistant')
+ROLES: Dict[str, str] = {role: role for role in [SYSTEM, USER, ASSISTANT]}
+
+
+class Message(object):
+    """
+    one message of a context, a third of the size of the equivalent dict
+
+    the role is one of the interned strings above, whatever string it was built from, and `n_tokens` is filled in
+    by ChatGPT.count_context_tokens the first time the message is counted
+    converted to {"role": ..., "content": ...} only when sent, see wire_format
+    """
+    __slots__ = ('role', 'content', 'n_tokens')
+
+    def __init__(self, role: str, content: str, n_tokens: Optional[int] = None):
+        self.role: str = ROLES.get(role, role)
+        self.content: str = content
+        self.n_tokens: Optional[int] = n_tokens
+
+    @classmethod
+    def from_dict(cls, message: dict) -> 'Message':
+        return cls(message['role'], message['content'])
+
+    def to_dict(self) -> dict:
+        return {'role': self.role, 'content': self.content}
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Message):
+            return NotImplemented
+        return self is other or (self.role == other.role and self.content == other.content)
+
+    def __hash__(self) -> int:
+        return hash((self.role, self.content))
+
+    def __repr__(self) -> str:
+        return f'Message({self.role!r}, {self.content[:32]!r})'
+
+
+shared_messages: Dict[Tuple[str, str], Message] = {}    # (role, content) -> the one instance of a shared message
+shared_lock = threading.Lock()
+
+
+def shared_message(role: str, content: str) -> Message:
+    """
+    the same Message for every context, e.g. one per version of a system prompt file, its tokens counted once
+    """
+    key = (role, content)
+    message = shared_messages.get(key)
+    if message is None:
+        with shared_lock:
+            message = shared_messages.setdefault(key, Message(role, content))
+    return message
+
+
+def find_shared(role: str, content: str) -> Optional[Message]:
+    return shared_messages.get((role, content))
+
+
+def to_messages(context: list) -> list:
+    """
+    `context` itself if it holds Message only, otherwise a copy with the dicts converted
+    """
+    if all(isinstance(message, Message) for message in context):
+        return context
+    return [message if isinstance(message, Message) else Message.from_dict(message) for message in context]
+
+
+def wire_format(context: list) -> List[dict]:
+    return [message.to_dict() if isinstance(message, Message) else message for message in context]
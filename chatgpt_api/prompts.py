@@ -0,0 +1,96 @@
+import os
+import time
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .message import Message, SYSTEM, shared_message
+
+
+class PromptEntry(object):
+    __slots__ = ('path', 'stamp', 'text', 'message')
+
+    def __init__(self, path: str, stamp: Tuple[int, int], text: str):
+        self.path: str = path
+        self.stamp: Tuple[int, int] = stamp     # (mtime_ns, size) of the file when read
+        self.text: str = text
+        self.message: Message = shared_message(SYSTEM, text)
+
+
+class PromptCache(object):
+    """
+    the prompt files of a directory, read once and kept in memory
+
+    at most every `check_interval` seconds, a lookup first checks the directory for new, removed and modified
+    files (one listdir and a stat per file), only those modified are read again; reload() rereads everything
+    `on_load` is called with the messages of the prompts (re)read, e.g. to count their tokens ahead of time
+    """
+
+    def __init__(self,
+                 prompts_dir: str,
+                 *,
+                 check_interval: float = 2.,
+                 on_load: Optional[Callable[[List[Message]], object]] = None,
+                 ):
+        self.prompts_dir: str = prompts_dir
+        self.check_interval: float = check_interval
+        self.on_load = on_load
+        self.entries: Dict[str, PromptEntry] = {}
+        self.last_check: float = 0.
+        self.lock = threading.Lock()
+        self.reload()
+
+    @staticmethod
+    def stamp(path: str) -> Tuple[int, int]:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+
+    @staticmethod
+    def read(path: str) -> str:
+        with open(path, 'r') as f:
+            return ''.join(f.readlines())
+
+    def list_files(self) -> Dict[str, str]:
+        files = {}
+        for fname in os.listdir(self.prompts_dir):
+            path = os.path.join(self.prompts_dir, fname)
+            if not fname.startswith('.') and os.path.isfile(path):   # e.g. .DS_Store
+                files[fname] = path
+        return files
+
+    def revalidate(self, force: bool = False) -> List[str]:
+        """
+        returns the names of the prompts read again
+        """
+        with self.lock:
+            entries = dict(self.entries)
+            changed = []
+            files = self.list_files()
+            for name in list(entries):
+                if name not in files:
+                    del entries[name]
+            for name, path in files.items():
+                # noinspection PyBroadException
+                try:
+                    stamp = self.stamp(path)
+                    entry = entries.get(name)
+                    if force or entry is None or entry.stamp != stamp:
+                        entries[name] = PromptEntry(path, stamp, self.read(path))
+                        changed.append(name)
+                except OSError:     # removed in between
+                    entries.pop(name, None)
+            self.entries = entries
+            self.last_check = time.monotonic()
+        if changed and self.on_load is not None:
+            self.on_load([entries[name].message for name in changed])
+        return changed
+
+    def reload(self) -> List[str]:
+        return self.revalidate(force=True)
+
+    def get_entry(self, name: str) -> Optional[PromptEntry]:
+        if time.monotonic() - self.last_check >= self.check_interval:
+            self.revalidate()
+        return self.entries.get(name)
+
+    def __contains__(self, name: str) -> bool:
+        return self.get_entry(name) is not None
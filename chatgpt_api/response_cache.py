@@ -0,0 +1,82 @@
+import json
+import time
+import asyncio
+import hashlib
+from functools import partial
+from typing import Callable, Optional
+
+from .cache import LRUCache
+from .message import Message
+
+
+class ResponseCache(object):
+    """
+    exact-match cache of completions, keyed by a hash of model, temperature and the normalized messages
+
+    entries live in a size-bounded in-memory LRU, and optionally in redis as well so that worker processes share
+    them; both expire after `ttl` seconds
+    inside the event loop use get_async / put_async, which leave the redis calls to the default executor
+    """
+
+    def __init__(self,
+                 *,
+                 maxsize: int = 1024,
+                 ttl: int = 3600,
+                 redis=None,
+                 prefix: str = 'completion:',
+                 ):
+        self.memory = LRUCache(maxsize=maxsize)     # key -> (expiry timestamp, content)
+        self.ttl: int = ttl
+        self.redis = redis
+        self.prefix: str = prefix
+
+    @staticmethod
+    def make_key(model_name: str,
+                 temperature: float,
+                 context: list,
+                 key_filter: Optional[Callable[[Message], bool]] = None,
+                 ) -> str:
+        """
+        whitespace is collapsed, messages rejected by `key_filter` do not take part in the key
+        """
+        messages = [[message.role, ' '.join(message.content.split())]
+                    for message in context if key_filter is None or key_filter(message)]
+        payload = json.dumps([model_name, float(temperature), messages], ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get_local(self, key: str) -> Optional[str]:
+        item = self.memory.get(key)
+        if item is not None:
+            expiry, content = item
+            if expiry > time.time():
+                return content
+            self.memory.pop(key)
+        return None
+
+    def get(self, key: str) -> Optional[str]:
+        content = self.get_local(key)
+        if content is not None or self.redis is None:
+            return content
+        content = self.redis.get(self.prefix + key)
+        if content is None:
+            return None
+        content = content.decode('utf-8')
+        self.memory.put(key, (time.time() + self.ttl, content))
+        return content
+
+    async def get_async(self, key: str) -> Optional[str]:
+        content = self.get_local(key)
+        if content is not None or self.redis is None:   # a memory hit never leaves the loop
+            return content
+        return await asyncio.get_running_loop().run_in_executor(None, self.get, key)
+
+    def put(self, key: str, content: str):
+        self.memory.put(key, (time.time() + self.ttl, content))
+        if self.redis is not None:
+            self.redis.set(self.prefix + key, content, ex=self.ttl)
+
+    async def put_async(self, key: str, content: str):
+        self.memory.put(key, (time.time() + self.ttl, content))
+        if self.redis is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, partial(self.redis.set, self.prefix + key, content, ex=self.ttl))
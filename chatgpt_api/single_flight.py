@@ -0,0 +1,67 @@
+import asyncio
+from typing import Dict, List, Optional
+
+
+class InflightStream(object):
+    """
+    deltas of an upstream stream in progress, which any number of followers can replay from the start and then
+    keep tailing until the stream is done
+
+    `failed` is set when the stream ended without a complete reply, upstream failed or the leader was cancelled
+    """
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done: bool = False
+        self.failed: bool = False
+        self.changed = asyncio.Event()
+
+    def _notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def append(self, chunk: str):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, failed: bool = False):
+        self.failed = failed
+        self.done = True
+        self._notify()
+
+    async def follow(self):
+        i = 0
+        while True:
+            changed = self.changed
+            while i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            if self.done:
+                return
+            await changed.wait()
+
+
+class SingleFlight(object):
+    """
+    registry of the upstream streams in progress, by request key
+    a request identical to one in flight follows it instead of opening another upstream stream
+    """
+
+    def __init__(self):
+        self.inflight: Dict[str, InflightStream] = {}
+
+    def get(self, key: str) -> Optional[InflightStream]:
+        return self.inflight.get(key)
+
+    def start(self, key: str) -> InflightStream:
+        stream = InflightStream()
+        self.inflight[key] = stream
+        return stream
+
+    def finish(self, key: str, stream: InflightStream, failed: bool = False):
+        stream.finish(failed)
+        if self.inflight.get(key) is stream:
+            del self.inflight[key]
+
+    def __len__(self) -> int:
+        return len(self.inflight)
@@ -0,0 +1,41 @@
+from typing import List
+
+
+class SSEDecoder(object):
+    """
+    incremental decoder for text/event-stream bodies
+
+    feed() takes raw byte chunks as they arrive from the socket, which may split lines or events anywhere,
+    and returns the 'data' payloads of every event completed so far
+    """
+
+    def __init__(self):
+        self._buffer: bytes = b''
+        self._data: List[str] = []
+
+    def feed(self, chunk: bytes) -> List[str]:
+        self._buffer += chunk
+        lines = self._buffer.split(b'\n')
+        self._buffer = lines.pop()  # incomplete tail, wait for the next chunk
+
+        events = []
+        for line in lines:
+            line = line.rstrip(b'\r')
+            if len(line) == 0:  # blank line dispatches the event
+                if self._data:
+                    events.append('\n'.join(self._data))
+                    self._data = []
+                continue
+            if line.startswith(b':'):  # comment / keep-alive
+                continue
+            field, _, value = line.partition(b':')
+            if value.startswith(b' '):
+                value = value[1:]
+            if field == b'data':
+                self._data.append(value.decode('utf-8'))
+        return events
+
+    def flush(self) -> List[str]:
+        events = self.feed(b'\n\n') if self._buffer or self._data else []
+        self._buffer = b''
+        return events
@@ -0,0 +1,153 @@
+import time
+import asyncio
+import hashlib
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .cache import LRUCache
+from .tokenizer import load_encoding
+
+
+process_encodings: Dict[Tuple[str, Optional[str]], object] = {}     # encodings loaded in a pool process
+
+
+def count_in_process(model_name: str, cache_dir: Optional[str], texts: List[str]) -> List[int]:
+    key = (model_name, cache_dir)
+    if key not in process_encodings:
+        process_encodings[key] = load_encoding(model_name, cache_dir)
+    return [len(tokens) for tokens in process_encodings[key].encode_ordinary_batch(texts, num_threads=1)]
+
+
+class TokenCounter(object):
+    """
+    memorized token counts, the strings missing from the cache are encoded together in one batch call
+    the cache is keyed by a digest of the text, never by the text itself, so it holds no message alive
+
+    the sync methods encode on the calling thread; the async ones on a dedicated executor so the event loop never
+    waits on the tokenizer, and send pastes of `process_threshold` characters or more to a process pool, if any
+    """
+
+    def __init__(self,
+                 model_name: str,
+                 *,
+                 cache_dir: Optional[str] = None,
+                 cache_size: int = 4096,
+                 num_threads: int = 1,
+                 num_processes: int = 0,
+                 process_threshold: int = 100000,
+                 metrics=None,
+                 ):
+        """
+
+        :param model_name:
+        :param cache_dir:       prebuilt tokenizer files, see chatgpt_api.tokenizer
+        :param cache_size:      number of distinct strings whose token count is memorized
+        :param num_threads:     threads of the tokenizer executor, also used by each batch call
+        :param num_processes:   size of the process pool for large pastes, 0 to encode everything in threads
+        :param process_threshold: length in characters from which a string goes to the process pool
+        :param metrics:         optional hook with observe_tokenize(seconds), called once per batch
+        """
+        self.model_name: str = model_name
+        self.cache_dir: Optional[str] = cache_dir
+        self.encoding = load_encoding(model_name, cache_dir)
+        self.cache = LRUCache(maxsize=cache_size)   # digest of the text -> number of tokens
+        self.num_threads: int = num_threads
+        self.num_processes: int = num_processes
+        self.process_threshold: int = process_threshold
+        self.metrics = metrics
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.process_pool: Optional[ProcessPoolExecutor] = None
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.num_threads, thread_name_prefix='tokenizer')
+        return self.executor
+
+    def get_process_pool(self) -> ProcessPoolExecutor:
+        if self.process_pool is None:
+            # spawned, forking a process running an event loop and its threads is not safe
+            self.process_pool = ProcessPoolExecutor(max_workers=self.num_processes,
+                                                    mp_context=multiprocessing.get_context('spawn'))
+        return self.process_pool
+
+    def encode(self, text: str) -> List[int]:
+        return self.encoding.encode(text)
+
+    async def encode_async(self, text: str) -> List[int]:
+        return await asyncio.get_running_loop().run_in_executor(self.get_executor(), self.encode, text)
+
+    def encode_counts(self, texts: List[str]) -> List[int]:
+        start = time.perf_counter()
+        if len(texts) == 1:
+            counts = [len(self.encoding.encode_ordinary(texts[0]))]
+        else:
+            counts = [len(tokens) for tokens in self.encoding.encode_ordinary_batch(texts,
+                                                                                    num_threads=self.num_threads)]
+        if self.metrics is not None:
+            self.metrics.observe_tokenize(time.perf_counter() - start)
+        return counts
+
+    @staticmethod
+    def cache_key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+    def lookup(self, texts: Sequence[str]) -> Tuple[List[Optional[int]], List[str]]:
+        """
+        cached counts, None where missing, and the distinct missing strings
+        """
+        counts = [self.cache.get(self.cache_key(text)) for text in texts]
+        missing = list(dict.fromkeys(text for text, count in zip(texts, counts) if count is None))
+        return counts, missing
+
+    def fill(self, texts: Sequence[str], counts: List[Optional[int]], missing: List[str], missing_counts: List[int]):
+        found = dict(zip(missing, missing_counts))
+        for text, count in found.items():
+            self.cache.put(self.cache_key(text), count)
+        return [count if count is not None else found[text] for text, count in zip(texts, counts)]
+
+    def count_many(self, texts: Sequence[str]) -> List[int]:
+        counts, missing = self.lookup(texts)
+        if not missing:
+            return counts
+        return self.fill(texts, counts, missing, self.encode_counts(missing))
+
+    async def count_many_async(self, texts: Sequence[str]) -> List[int]:
+        counts, missing = self.lookup(texts)
+        if not missing:     # the usual case, no hop to another thread
+            return counts
+        loop = asyncio.get_running_loop()
+        large = []
+        if self.num_processes > 0:
+            large = [text for text in missing if len(text) >= self.process_threshold]
+        small = [text for text in missing if len(text) < self.process_threshold] if large else missing
+        jobs = []
+        if small:
+            jobs.append(loop.run_in_executor(self.get_executor(), self.encode_counts, small))
+        if large:
+            jobs.append(loop.run_in_executor(self.get_process_pool(), count_in_process,
+                                             self.model_name, self.cache_dir, large))
+        results = await asyncio.gather(*jobs)
+        missing_counts = [count for result in results for count in result]
+        return self.fill(texts, counts, small + large, missing_counts)
+
+    def count(self, text: str) -> int:
+        return self.count_many([text])[0]
+
+    async def count_async(self, text: str) -> int:
+        return (await self.count_many_async([text]))[0]
+
+    async def count_uncached_async(self, text: str) -> int:
+        """
+        counted off the event loop without going into the cache, for one-off strings such as a whole reply
+        """
+        loop = asyncio.get_running_loop()
+        return (await loop.run_in_executor(self.get_executor(), self.encode_counts, [text]))[0]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        if self.process_pool is not None:
+            self.process_pool.shutdown(wait=False)
+            self.process_pool = None
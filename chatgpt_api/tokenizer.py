@@ -0,0 +1,122 @@
+"""
+offline tokenizer assets
+
+tiktoken looks up its BPE files in $TIKTOKEN_CACHE_DIR, under the sha1 of their url, before downloading them;
+pointed at a directory filled ahead of time, encodings load with no network access at all
+
+    python -m chatgpt_api.tokenizer --cache-dir ./tokenizer                     # download
+    python -m chatgpt_api.tokenizer --cache-dir ./tokenizer --from cl100k_base.tiktoken     # air-gapped copy
+"""
+import os
+import shutil
+import hashlib
+import argparse
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import tiktoken
+from .exception import TokenizerAssetError
+
+
+# BPE files of the encodings used by the supported models
+ENCODING_URLS: Dict[str, str] = {
+    'cl100k_base': 'https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken',
+}
+MODEL_ENCODINGS: Dict[str, str] = {
+    'gpt-3.5-turbo': 'cl100k_base',
+    'gpt-3.5-turbo-0301': 'cl100k_base',
+}
+
+lock = threading.Lock()
+
+
+def encoding_name(model_name: str) -> str:
+    return MODEL_ENCODINGS.get(model_name, 'cl100k_base')
+
+
+def asset_path(cache_dir: str, encoding: str) -> str:
+    return os.path.join(cache_dir, hashlib.sha1(ENCODING_URLS[encoding].encode()).hexdigest())
+
+
+def missing_assets(cache_dir: str, model_name: str) -> List[str]:
+    encoding = encoding_name(model_name)
+    return [encoding] if not os.path.isfile(asset_path(cache_dir, encoding)) else []
+
+
+def check_tokenizer_assets(cache_dir: str, model_name: str):
+    missing = missing_assets(cache_dir, model_name)
+    if missing:
+        raise TokenizerAssetError(
+            f"tokenizer files {missing} not found under '{cache_dir}', "
+            f"run 'python -m chatgpt_api.tokenizer --cache-dir {cache_dir}' first")
+
+
+@contextmanager
+def tiktoken_cache_dir(cache_dir: str):
+    """
+    points tiktoken at `cache_dir` for the duration of the block only, other loads in the process keep their own
+    """
+    with lock:
+        previous = os.environ.get('TIKTOKEN_CACHE_DIR')
+        os.environ['TIKTOKEN_CACHE_DIR'] = os.path.abspath(cache_dir)
+        try:
+            yield
+        finally:
+            if previous is None:
+                del os.environ['TIKTOKEN_CACHE_DIR']
+            else:
+                os.environ['TIKTOKEN_CACHE_DIR'] = previous
+
+
+def load_encoding(model_name: str, cache_dir: Optional[str] = None) -> tiktoken.Encoding:
+    """
+    loads from `cache_dir` only when given, failing rather than downloading if the file is not there
+    tiktoken keeps one Encoding per name, so every ChatGPT instance shares it
+    """
+    encoding = encoding_name(model_name)
+    if cache_dir is None:
+        return tiktoken.get_encoding(encoding)
+    check_tokenizer_assets(cache_dir, model_name)
+    with tiktoken_cache_dir(cache_dir):
+        return tiktoken.get_encoding(encoding)
+
+
+def prebuild(cache_dir: str, encodings: List[str], source: Optional[str] = None) -> List[str]:
+    """
+    fills `cache_dir` with the BPE files of `encodings`, downloaded, or copied from `source` for a single encoding
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    paths = []
+    with tiktoken_cache_dir(cache_dir):
+        for encoding in encodings:
+            path = asset_path(cache_dir, encoding)
+            if source is not None:
+                shutil.copyfile(source, path)
+            tiktoken.get_encoding(encoding).encode('hello world')   # downloads if missing, checks the file otherwise
+            paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fill the offline tokenizer cache')
+    parser.add_argument('--cache-dir', default=None, help='defaults to TOKENIZER_DIR of config/config_en.py')
+    parser.add_argument('--encoding', action='append', choices=sorted(ENCODING_URLS),
+                        help='repeatable, defaults to all of them')
+    parser.add_argument('--from', dest='source', default=None,
+                        help='local copy of the .tiktoken file, for machines without network access')
+    args = parser.parse_args()
+
+    cache_dir = args.cache_dir
+    if cache_dir is None:
+        from config.config_en import Args
+        cache_dir = Args.TOKENIZER_DIR
+    encodings = args.encoding or sorted(ENCODING_URLS)
+    if args.source is not None and len(encodings) != 1:
+        parser.error('--from takes the file of a single --encoding')
+    for path in prebuild(cache_dir, encodings, source=args.source):
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
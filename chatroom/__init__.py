@@ -0,0 +1,40 @@
+from .scheduler import CompletionScheduler
+from .sockets import SocketManager, ConnectionWriter
+from .frames import Frame, create_response, encode_frame
+from .coalesce import DeltaCoalescer, CoalescerStats
+from .compaction import ContextCompactor
+from .context_store import ContextStore
+from .transport import MessageTransport, LocalTransport, RedisStreamTransport
+from .cluster import ClusterBus, Presence, LeaderElection
+from .rate_limit import RateLimiter, TokenBucket
+from .metrics import MetricsRegistry, ChatMetrics, Counter, Gauge, Histogram
+from .logs import setup_logging, stop_logging, JsonFormatter
+
+__all__ = [
+    'CompletionScheduler',
+    'SocketManager',
+    'ConnectionWriter',
+    'Frame',
+    'create_response',
+    'encode_frame',
+    'DeltaCoalescer',
+    'CoalescerStats',
+    'ContextCompactor',
+    'ContextStore',
+    'MessageTransport',
+    'LocalTransport',
+    'RedisStreamTransport',
+    'ClusterBus',
+    'Presence',
+    'LeaderElection',
+    'RateLimiter',
+    'TokenBucket',
+    'MetricsRegistry',
+    'ChatMetrics',
+    'Counter',
+    'Gauge',
+    'Histogram',
+    'setup_logging',
+    'stop_logging',
+    'JsonFormatter',
+]
@@ -0,0 +1,245 @@
+import os
+import time
+import queue
+import asyncio
+import socket
+import threading
+import logging
+from typing import List, Optional
+
+from redis import Redis
+
+from .frames import Frame
+from .sockets import SocketManager
+
+
+logger = logging.getLogger(__name__)
+
+
+def default_node_id() -> str:
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class ClusterBus(object):
+    """
+    relays broadcast frames between worker processes / nodes over redis pub/sub
+
+    frames published on this node are sent already encoded, by a background thread so the event loop never waits
+    on redis, and frames from other nodes are fanned out to the local connections
+    """
+
+    def __init__(self,
+                 redis: Redis,
+                 *,
+                 channel: str = 'room_frames',
+                 node_id: Optional[str] = None,
+                 ):
+        self.redis: Redis = redis
+        self.channel: str = channel
+        self.node_id: str = node_id if node_id is not None else default_node_id()
+        self.outbox: queue.SimpleQueue = queue.SimpleQueue()
+        self.manager: Optional[SocketManager] = None
+        self.stopped = threading.Event()
+        self.threads: List[threading.Thread] = []
+
+    def attach(self, manager: SocketManager):
+        self.manager = manager
+        manager.relay = self.relay
+        for target in [self._send, self._listen]:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def close(self, timeout: float = 5.):
+        """
+        blocking, stops both threads, the frames already in the outbox are sent first
+        """
+        if self.manager is not None and self.manager.relay == self.relay:
+            self.manager.relay = None
+        self.stopped.set()
+        self.outbox.put(None)   # wakes the sender up
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def relay(self, frame: Frame):
+        self.outbox.put(frame)
+
+    def _send(self):
+        prefix = f'{self.node_id}\n'
+        while True:
+            frames = [self.outbox.get()]
+            while not self.outbox.empty() and len(frames) < 256:
+                frames.append(self.outbox.get())
+            # noinspection PyBroadException
+            try:
+                pipeline = self.redis.pipeline(transaction=False)
+                for frame in frames:
+                    if frame is not None:
+                        pipeline.publish(self.channel, prefix + frame.text)
+                pipeline.execute()
+            except Exception:
+                logger.exception('failed to relay frames')
+            if any(frame is None for frame in frames):
+                return
+
+    def _listen(self):
+        while not self.stopped.is_set():
+            # noinspection PyBroadException
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                try:
+                    pubsub.subscribe(self.channel)
+                    while not self.stopped.is_set():
+                        message = pubsub.get_message(timeout=1.)
+                        if message is None:
+                            continue
+                        node_id, _, text = message['data'].decode('utf-8').partition('\n')
+                        if node_id != self.node_id:
+                            self.manager.publish_local(Frame.from_text(text))
+                finally:
+                    pubsub.close()
+            except Exception:
+                logger.exception('cluster listener failed, reconnecting')
+                self.stopped.wait(1.)
+
+
+class Presence(object):
+    """
+    cluster-wide registry of online users
+
+    each node refreshes the expiry of its own users, users of a node that died drop out after `ttl` seconds
+    inside the event loop use the *_async methods, which leave the redis calls to the default executor
+    """
+
+    def __init__(self,
+                 redis: Redis,
+                 *,
+                 key: str = 'presence',
+                 node_id: Optional[str] = None,
+                 ttl: int = 30,
+                 ):
+        self.redis: Redis = redis
+        self.expiry_key: str = f'{key}:expiry'  # sorted set, user -> expiry timestamp
+        self.owner_key: str = f'{key}:owner'    # hash, user -> node id
+        self.node_id: str = node_id if node_id is not None else default_node_id()
+        self.ttl: int = ttl
+        self.local_users = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self.thread.start()
+
+    def close(self, timeout: float = 5.):
+        """
+        blocking, stops the heartbeat, the users of this node then drop out after `ttl` seconds
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def join(self, user: str):
+        with self.lock:
+            self.local_users.add(user)
+        pipeline = self.redis.pipeline()
+        pipeline.zadd(self.expiry_key, {user: time.time() + self.ttl})
+        pipeline.hset(self.owner_key, user, self.node_id)
+        pipeline.execute()
+
+    def leave(self, user: str):
+        with self.lock:
+            self.local_users.discard(user)
+        owner = self.redis.hget(self.owner_key, user)
+        if owner is not None and owner.decode('utf-8') == self.node_id:
+            pipeline = self.redis.pipeline()
+            pipeline.zrem(self.expiry_key, user)
+            pipeline.hdel(self.owner_key, user)
+            pipeline.execute()
+
+    def is_online(self, user: str) -> bool:
+        expiry = self.redis.zscore(self.expiry_key, user)
+        return expiry is not None and expiry > time.time()
+
+    def users(self) -> set:
+        members = self.redis.zrangebyscore(self.expiry_key, time.time(), '+inf')
+        return {member.decode('utf-8') for member in members}
+
+    def count(self) -> int:
+        return self.redis.zcount(self.expiry_key, time.time(), '+inf')
+
+    async def join_async(self, user: str):
+        await asyncio.get_running_loop().run_in_executor(None, self.join, user)
+
+    async def leave_async(self, user: str):
+        await asyncio.get_running_loop().run_in_executor(None, self.leave, user)
+
+    async def users_async(self) -> set:
+        return await asyncio.get_running_loop().run_in_executor(None, self.users)
+
+    def _heartbeat(self):
+        while not self.stopped.wait(self.ttl / 3):
+            # noinspection PyBroadException
+            try:
+                with self.lock:
+                    users = list(self.local_users)
+                expiry = time.time() + self.ttl
+                pipeline = self.redis.pipeline()
+                if users:
+                    pipeline.zadd(self.expiry_key, {user: expiry for user in users})
+                pipeline.zremrangebyscore(self.expiry_key, '-inf', time.time())
+                pipeline.execute()
+            except Exception:
+                logger.exception('presence heartbeat failed')
+
+
+class LeaderElection(object):
+    """
+    lease held in a redis key, the holder renews it well before it expires
+    used to run a single ChatGPT consumer across the cluster
+    """
+
+    RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+    def __init__(self,
+                 redis: Redis,
+                 *,
+                 key: str = 'chatgpt_leader',
+                 node_id: Optional[str] = None,
+                 ttl_ms: int = 10000,
+                 ):
+        self.redis: Redis = redis
+        self.key: str = key
+        self.node_id: str = node_id if node_id is not None else default_node_id()
+        self.ttl_ms: int = ttl_ms
+        self.renew_script = redis.register_script(self.RENEW_SCRIPT)
+        self.deadline: float = 0.   # local view of when the lease runs out
+
+    @property
+    def is_leader(self) -> bool:
+        return time.monotonic() < self.deadline
+
+    def campaign(self) -> bool:
+        """
+        acquire or renew the lease, returns whether this node holds it
+        """
+        start = time.monotonic()
+        acquired = self.renew_script(keys=[self.key], args=[self.node_id, self.ttl_ms]) == 1
+        if not acquired:
+            acquired = bool(self.redis.set(self.key, self.node_id, nx=True, px=self.ttl_ms))
+        self.deadline = start + self.ttl_ms / 1000. if acquired else 0.
+        return acquired
+
+    def resign(self):
+        if self.is_leader:
+            self.redis.eval("if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end",
+                            1, self.key, self.node_id)
+        self.deadline = 0.
@@ -0,0 +1,68 @@
+import time
+import asyncio
+from typing import Callable, List, Optional
+
+
+class CoalescerStats(object):
+    def __init__(self):
+        self.deltas_in: int = 0
+        self.frames_out: int = 0
+
+    @property
+    def frames_saved(self) -> int:
+        return self.deltas_in - self.frames_out
+
+
+class DeltaCoalescer(object):
+    """
+    buffers the deltas of one stream and emits them joined, flushing when
+        - `window_ms` has passed since the last flush (the first delta after a quiet period goes out at once)
+        - the buffer reaches `max_bytes`
+        - the stream ends, see close()
+    window_ms <= 0 disables coalescing
+    """
+
+    def __init__(self,
+                 emit: Callable[[str], None],
+                 *,
+                 window_ms: float = 40.,
+                 max_bytes: int = 512,
+                 stats: Optional[CoalescerStats] = None,
+                 ):
+        self.emit = emit
+        self.window: float = window_ms / 1000.
+        self.max_bytes: int = max_bytes
+        self.stats: CoalescerStats = stats if stats is not None else CoalescerStats()
+        self.buffer: List[str] = []
+        self.n_bytes: int = 0
+        self.last_flush: float = 0.
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def add(self, text: str):
+        if len(text) == 0:
+            return
+        self.stats.deltas_in += 1
+        self.buffer.append(text)
+        self.n_bytes += len(text.encode('utf-8'))
+
+        wait = self.last_flush + self.window - time.monotonic()
+        if wait <= 0 or self.n_bytes >= self.max_bytes:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(wait, self.flush)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.last_flush = time.monotonic()
+        if len(self.buffer) == 0:
+            return
+        text = ''.join(self.buffer)
+        self.buffer = []
+        self.n_bytes = 0
+        self.stats.frames_out += 1
+        self.emit(text)
+
+    def close(self):
+        self.flush()
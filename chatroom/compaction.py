@@ -0,0 +1,78 @@
+import asyncio
+import functools
+import logging
+from typing import Dict, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+class ContextCompactor(object):
+    """
+    keeps user contexts under budget off the request path
+
+    after a reply, a context above the soft watermark gets summarized by a background task, the next turn of the
+    same user picks up the result; a turn only waits for the task when the context has no budget left at all
+    """
+
+    def __init__(self,
+                 chatgpt,
+                 *,
+                 keep_left: int = 2,
+                 keep_right: int = 1,
+                 ):
+        self.chatgpt = chatgpt
+        self.keep_left: int = keep_left
+        self.keep_right: int = keep_right
+        self.tasks: Dict[str, asyncio.Task] = {}    # in flight, popped once done
+        self.results: Dict[str, Tuple[list, tuple]] = {}    # finished, until picked up by the next turn
+
+    async def schedule(self, user: str, context: list):
+        if user in self.tasks:
+            return
+        if not await self.chatgpt.needs_compaction(context):
+            return
+        snapshot = list(context)
+        task = asyncio.ensure_future(self._compact(snapshot))
+        task.add_done_callback(functools.partial(self._done, user))
+        self.tasks[user] = task
+
+    def _done(self, user: str, task: asyncio.Task):
+        if self.tasks.get(user) is task:
+            del self.tasks[user]
+        if task.cancelled():
+            return
+        # noinspection PyBroadException
+        try:
+            snapshot, result = task.result()
+        except Exception:
+            logger.exception('context compaction of %s failed', user)
+            return
+        if result is not None:
+            self.results[user] = snapshot, result
+
+    def forget(self, user: str):
+        """
+        drop the compaction of `user`, in flight or finished
+        """
+        task = self.tasks.pop(user, None)
+        if task is not None:
+            task.cancel()
+        self.results.pop(user, None)
+
+    async def _compact(self, snapshot: list):
+        result = await self.chatgpt.compact_context_async(
+            snapshot, keep_left=self.keep_left, keep_right=self.keep_right)
+        return snapshot, result
+
+    async def apply(self, user: str, context: list) -> list:
+        """
+        return `context` with the finished compaction of `user` swapped in, if any
+        """
+        task = self.tasks.get(user)
+        if task is not None and await self.chatgpt.exceeds_budget(context):
+            await asyncio.wait([task])
+        if user not in self.results:
+            return context
+        snapshot, (compacted, split) = self.results.pop(user)
+        return self.chatgpt.apply_compaction(context, snapshot, compacted, split)
@@ -0,0 +1,163 @@
+import json
+import time
+import zlib
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from redis import Redis
+from chatgpt_api import Message, SYSTEM, find_shared
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dump_context(context: list) -> bytes:
+    pairs = [[message.role, message.content] for message in context]
+    if orjson is not None:
+        return orjson.dumps(pairs)
+    return json.dumps(pairs, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def load_context(blob: bytes) -> list:
+    """
+    system prompts shared by every context come back as the shared message rather than a copy of it
+    """
+    pairs = orjson.loads(blob) if orjson is not None else json.loads(blob)
+    return [(role == SYSTEM and find_shared(role, content)) or Message(role, content) for role, content in pairs]
+
+
+class ContextStore(object):
+    """
+    conversation contexts by user, in two tiers
+        hot:    in-process LRU of live message lists, bounded by `max_hot_bytes` in total
+        redis:  zlib-compressed [[role, content], ...] written through on every update, shared by workers and
+                surviving restarts, expiring after `idle_ttl` seconds without update
+    a single context is bounded by `max_user_bytes`, beyond which its oldest non-system messages are dropped
+    sizes are measured on the uncompressed serialized form
+    the hot tier is per process and never told of writes made elsewhere, `max_hot_bytes` = 0 turns it off, as
+    needed when several nodes serve the same users; the *_async methods leave redis and zlib to the default executor
+    """
+
+    def __init__(self,
+                 redis: Optional[Redis] = None,
+                 *,
+                 prefix: str = 'context:',
+                 max_user_bytes: int = 256 * 1024,
+                 max_hot_bytes: int = 64 * 1024 * 1024,
+                 idle_ttl: int = 3600,
+                 keep_left: int = 2,
+                 ):
+        self.redis: Optional[Redis] = redis
+        self.prefix: str = prefix
+        self.max_user_bytes: int = max_user_bytes
+        self.max_hot_bytes: int = max_hot_bytes
+        self.idle_ttl: int = idle_ttl
+        self.keep_left: int = keep_left
+
+        self.hot: OrderedDict = OrderedDict()   # user -> (context, n_bytes, last access)
+        self.hot_bytes: int = 0
+        self.lock = threading.Lock()    # used from both the server loop and the ChatGPT worker
+
+    def key(self, user: str) -> str:
+        return f'{self.prefix}{user}'
+
+    def _trim(self, context: list) -> Tuple[list, bytes]:
+        blob = dump_context(context)
+        if len(blob) <= self.max_user_bytes or len(context) <= self.keep_left + 1:
+            return context, blob
+        excess = len(blob) - self.max_user_bytes
+        kept = context[:self.keep_left]
+        for message in context[self.keep_left:-1]:
+            if excess > 0 and message.role != SYSTEM:
+                excess -= len(dump_context([message]))
+                continue
+            kept.append(message)
+        kept += context[-1:]
+        return kept, dump_context(kept)
+
+    def _hot_pop(self, user: str):
+        item = self.hot.pop(user, None)
+        if item is not None:
+            self.hot_bytes -= item[1]
+
+    def _hot_put(self, user: str, context: list, n_bytes: int):
+        self._hot_pop(user)
+        if self.max_hot_bytes <= 0:
+            return
+        self.hot[user] = (context, n_bytes, time.monotonic())
+        self.hot_bytes += n_bytes
+        self._evict()
+
+    def _evict(self):
+        deadline = time.monotonic() - self.idle_ttl
+        while self.hot:
+            user, (_, n_bytes, last_access) = next(iter(self.hot.items()))
+            if self.hot_bytes <= self.max_hot_bytes and last_access >= deadline:
+                break
+            self._hot_pop(user)     # still in redis, if any
+
+    def _hot_get(self, user: str) -> Optional[list]:
+        with self.lock:
+            item = self.hot.get(user)
+            if item is None:
+                return None
+            context, n_bytes, _ = item
+            self._hot_put(user, context, n_bytes)
+            return context
+
+    def _load(self, user: str) -> Optional[list]:
+        blob = self.redis.get(self.key(user))
+        if blob is None:
+            return None
+        blob = zlib.decompress(blob)
+        context = load_context(blob)
+        with self.lock:
+            self._hot_put(user, context, len(blob))
+        return context
+
+    def get(self, user: str) -> Optional[list]:
+        context = self._hot_get(user)
+        if context is not None or self.redis is None:
+            return context
+        return self._load(user)
+
+    async def get_async(self, user: str) -> Optional[list]:
+        context = self._hot_get(user)
+        if context is not None or self.redis is None:   # a hot hit never leaves the loop
+            return context
+        return await asyncio.get_running_loop().run_in_executor(None, self._load, user)
+
+    def set(self, user: str, context: list):
+        context, blob = self._trim(context)
+        with self.lock:
+            self._hot_put(user, context, len(blob))
+        if self.redis is not None:
+            self.redis.set(self.key(user), zlib.compress(blob, 1), ex=self.idle_ttl)
+
+    async def set_async(self, user: str, context: list):
+        if self.redis is None:
+            self.set(user, context)
+        else:
+            await asyncio.get_running_loop().run_in_executor(None, self.set, user, context)
+
+    def delete(self, user: str):
+        with self.lock:
+            self._hot_pop(user)
+        if self.redis is not None:
+            self.redis.delete(self.key(user))
+
+    async def delete_async(self, user: str):
+        if self.redis is None:
+            self.delete(user)
+        else:
+            await asyncio.get_running_loop().run_in_executor(None, self.delete, user)
+
+    def __contains__(self, user: str) -> bool:
+        with self.lock:
+            if user in self.hot:
+                return True
+        return self.redis is not None and self.redis.exists(self.key(user)) > 0
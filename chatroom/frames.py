@@ -0,0 +1,86 @@
+import json
+from typing import Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# fields equal to their default are left out of the wire format, chat.html fills them back in
+FRAME_DEFAULTS = {
+    "time_str": "",
+    "sender": "",
+    "receiver": "",
+    "message": "",
+    "italic": False,
+    "strong": False,
+    "color": "",
+    "complete": True,
+    "room": "",     # all rooms
+}
+
+
+def create_response(
+        message: str = "",
+        *,
+        time_str: str = "",
+        sender: str = "",
+        receiver: str = "",
+        italic: bool = False,
+        strong: bool = False,
+        color: str = "",
+        complete: bool = True,
+        room: str = "",
+):
+    response = {
+        "time_str": time_str,
+        "sender": sender,
+        "receiver": receiver,
+        "message": message,
+        "italic": italic,
+        "strong": strong,
+        "color": color,
+        "complete": complete,
+        "room": room,
+    }
+    return response
+
+
+def encode_frame(data: dict) -> str:
+    compact = {key: value for key, value in data.items() if key not in FRAME_DEFAULTS or FRAME_DEFAULTS[key] != value}
+    if orjson is not None:
+        return orjson.dumps(compact).decode('utf-8')
+    return json.dumps(compact, ensure_ascii=False, separators=(',', ':'))
+
+
+class Frame(object):
+    """
+    a broadcast message, serialized at most once no matter how many sockets it is sent to
+    """
+    __slots__ = ('data', '_text')
+
+    def __init__(self, data: dict):
+        self.data: dict = data
+        self._text: Optional[str] = None
+
+    @classmethod
+    def from_text(cls, text: str) -> 'Frame':
+        """
+        rebuild a frame received already encoded, e.g. from another node, without encoding it again
+        """
+        compact = orjson.loads(text) if orjson is not None else json.loads(text)
+        frame = cls(dict(FRAME_DEFAULTS, **compact))
+        frame._text = text
+        return frame
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = encode_frame(self.data)
+        return self._text
+
+    @property
+    def is_delta(self) -> bool:
+        data = self.data
+        return not data.get('complete', True) and len(data.get('time_str', '')) == 0
@@ -0,0 +1,142 @@
+import os
+import json
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# attributes every LogRecord has, anything else was passed through `extra` and is a structured field
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+def record_fields(record: logging.LogRecord) -> dict:
+    return {key: value for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    one JSON object per line: time, level, logger, message, the `extra` fields, and the traceback if any
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': self.formatTime(record, '%Y-%m-%d %H:%M:%S'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        data.update(record_fields(record))
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exc_info'] = record.exc_text
+        if orjson is not None:
+            return orjson.dumps(data, default=str).decode('utf-8')
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class ConsoleFormatter(logging.Formatter):
+    """
+    [time] message key=value ..., for humans tailing console.log
+    """
+
+    def __init__(self):
+        super().__init__('[%(asctime)s] %(message)s', '%Y-%m-%d %H:%M:%S')
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        fields = record_fields(record)
+        if fields:
+            head, _, tail = text.partition('\n')    # fields go before any traceback
+            text = head + ' ' + ' '.join(f'{key}={value}' for key, value in fields.items()) + _ + tail
+        return text
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    hands records over to the listener thread as they are, the formatting and the writes happen there
+    the queue is unbounded so logging never blocks the caller
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()    # arguments may change by the time the listener gets to them
+        record.args = None
+        if record.exc_info:     # frames are released once the handler returns, render the traceback now
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class LogListener(QueueListener):
+    """
+    QueueListener that knows whether it runs, and the handler it was fed by on the root logger
+    """
+
+    def __init__(self, log_queue, *handlers, respect_handler_level: bool = False):
+        super().__init__(log_queue, *handlers, respect_handler_level=respect_handler_level)
+        self.queue_handler: Optional[QueueHandler] = None
+        self.running: bool = False
+
+    def start(self):
+        super().start()
+        self.running = True
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        super().stop()
+
+
+def setup_logging(log_dir: str,
+                  *,
+                  level: str = 'info',
+                  console: bool = True,
+                  max_bytes: int = 10 * 1024 * 1024,
+                  backup_count: int = 5,
+                  filename: str = 'chatroom.log',
+                  ) -> LogListener:
+    """
+    route every log record through a queue to a background thread, which writes JSON lines to a size-rotated
+    file under `log_dir` and plain text to the console
+
+    returns the started listener, stopped (and flushed) at exit
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    file_handler = RotatingFileHandler(os.path.join(log_dir, filename), maxBytes=max_bytes,
+                                       backupCount=backup_count, encoding='utf-8')
+    file_handler.setFormatter(JsonFormatter())
+    handlers = [file_handler]
+    if console:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(ConsoleFormatter())
+        handlers.append(console_handler)
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = LogListener(log_queue, *handlers, respect_handler_level=True)
+    listener.queue_handler = NonBlockingQueueHandler(log_queue)
+    root = logging.getLogger()
+    root.addHandler(listener.queue_handler)
+    root.setLevel(level.upper())
+    listener.start()
+    atexit.register(stop_logging, listener)
+    return listener
+
+
+def stop_logging(listener: Optional[LogListener]):
+    """
+    detaches the listener's handler from the root logger, writes out what is queued and closes the files
+    """
+    if listener is None or not listener.running:
+        return
+    logging.getLogger().removeHandler(listener.queue_handler)
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
@@ -0,0 +1,252 @@
+import math
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60.)
+FAST_BUCKETS = (.00001, .00005, .0001, .0005, .001, .005, .01, .05, .1)
+RATE_BUCKETS = (1., 2., 5., 10., 20., 50., 100., 200., 500.)
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric(object):
+    """
+    a named family of samples, one per combination of label values
+    """
+    type_name: str = 'untyped'
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name: str = name
+        self.help_text: str = help_text
+        self.labelnames: Tuple[str, ...] = tuple(labelnames)
+        self.lock = threading.Lock()    # observed from both the server loop and the ChatGPT worker
+
+    def key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def format_labels(self, key: Tuple[str, ...], extra: Sequence[Tuple[str, str]] = ()) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if len(pairs) == 0:
+            return ''
+        return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.type_name}']
+        lines.extend(self.samples())
+        return lines
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1., **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.) + amount
+
+    def samples(self) -> Iterable[str]:
+        with self.lock:
+            items = list(self.values.items())
+        for key, value in items:
+            yield f'{self.name}{self.format_labels(key)} {format_value(value)}'
+
+
+class Gauge(Metric):
+    """
+    set directly, or read from a callback at scrape time
+    """
+    type_name = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Tuple[str, ...], float] = {}
+        self.functions: Dict[Tuple[str, ...], Callable[[], float]] = {}
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def set_function(self, function: Callable[[], float], **labels):
+        with self.lock:
+            self.functions[self.key(labels)] = function
+
+    def samples(self) -> Iterable[str]:
+        with self.lock:
+            values = dict(self.values)
+            functions = list(self.functions.items())
+        for key, function in functions:
+            values[key] = function()
+        for key, value in values.items():
+            yield f'{self.name}{self.format_labels(key)} {format_value(value)}'
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, *args, buckets: Sequence[float] = LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets: Tuple[float, ...] = tuple(sorted(buckets))
+        self.values: Dict[Tuple[str, ...], list] = {}   # key -> [count per bucket (+Inf last), sum]
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            item = self.values.get(key)
+            if item is None:
+                item = self.values[key] = [[0] * (len(self.buckets) + 1), 0.]
+            item[0][i] += 1
+            item[1] += value
+
+    def samples(self) -> Iterable[str]:
+        with self.lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = self.format_labels(key, [('le', format_value(bound))])
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            yield f'{self.name}_sum{self.format_labels(key)} {format_value(total)}'
+            yield f'{self.name}_count{self.format_labels(key)} {cumulative}'
+
+
+class MetricsRegistry(object):
+    """
+    minimal in-process registry rendered in the Prometheus text exposition format
+    """
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, prefix: str = ''):
+        self.prefix: str = prefix
+        self.metrics: Dict[str, Metric] = {}
+
+    def _add(self, metric: Metric) -> Metric:
+        assert metric.name not in self.metrics, f"metric '{metric.name}' is already registered"
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(self.prefix + name, help_text, labelnames))
+
+    def gauge(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(self.prefix + name, help_text, labelnames))
+
+    def histogram(self,
+                  name: str,
+                  help_text: str,
+                  labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS,
+                  ) -> Histogram:
+        return self._add(Histogram(self.prefix + name, help_text, labelnames, buckets=buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class ChatMetrics(object):
+    """
+    the chat room's metrics, every series labeled by model
+
+    also the hook ChatGPT reports to (duck-typed, see the `metrics` parameter of ChatGPT), and the one
+    SocketManager reports fan-out latency to
+    """
+
+    def __init__(self, registry: Optional[MetricsRegistry] = None, *, model: str = ''):
+        self.registry: MetricsRegistry = registry if registry is not None else MetricsRegistry(prefix='chatroom_')
+        self.model: str = model
+        registry = self.registry
+        self.queue_depth = registry.gauge(
+            'queue_depth', 'requests waiting for a completion slot', ['model'])
+        self.queue_wait = registry.histogram(
+            'queue_wait_seconds', 'time from scheduling to the start of a completion', ['model'])
+        self.time_to_first_token = registry.histogram(
+            'time_to_first_token_seconds', 'time from the upstream request to the first streamed token', ['model'])
+        self.tokens_per_second = registry.histogram(
+            'completion_tokens_per_second', 'streaming rate after the first token', ['model'], buckets=RATE_BUCKETS)
+        self.completion_latency = registry.histogram(
+            'completion_seconds', 'time from the upstream request to the end of the stream', ['model'])
+        self.tokenizer_latency = registry.histogram(
+            'tokenizer_seconds', 'time to encode the strings missing from the token count cache, per batch', ['model'],
+            buckets=FAST_BUCKETS)
+        self.consolidations = registry.counter(
+            'consolidations_total', 'contexts consolidated, inline on the request path or in background',
+            ['model', 'kind'])
+        self.consolidation_latency = registry.histogram(
+            'consolidation_seconds', 'time to consolidate one context', ['model', 'kind'])
+        self.fanout_latency = registry.histogram(
+            'fanout_seconds', 'time from publishing a frame to having it queued on every connection', ['model'],
+            buckets=FAST_BUCKETS)
+        self.active_connections = registry.gauge(
+            'active_connections', 'websocket connections of this process', ['model'])
+        self.upstream_errors = registry.counter(
+            'upstream_errors_total', 'failed upstream requests by type', ['model', 'type'])
+        self.startup_latency = registry.gauge(
+            'startup_seconds', 'time spent on each step of the warm-up, and in total', ['model', 'step'])
+        self.stream_deltas = registry.counter(
+            'stream_deltas_total', 'reply deltas received from upstream, before coalescing', ['model'])
+        self.stream_frames = registry.counter(
+            'stream_frames_total', 'reply frames published to the room, after coalescing', ['model'])
+
+    def watch_queue_depth(self, function: Callable[[], float]):
+        self.queue_depth.set_function(function, model=self.model)
+
+    def watch_connections(self, function: Callable[[], float]):
+        self.active_connections.set_function(function, model=self.model)
+
+    def observe_queue_wait(self, seconds: float):
+        self.queue_wait.observe(seconds, model=self.model)
+
+    def observe_fanout(self, seconds: float):
+        self.fanout_latency.observe(seconds, model=self.model)
+
+    def observe_tokenize(self, seconds: float):
+        self.tokenizer_latency.observe(seconds, model=self.model)
+
+    def observe_consolidation(self, kind: str, seconds: float):
+        self.consolidations.inc(model=self.model, kind=kind)
+        self.consolidation_latency.observe(seconds, model=self.model, kind=kind)
+
+    def observe_first_token(self, seconds: float):
+        self.time_to_first_token.observe(seconds, model=self.model)
+
+    def observe_completion(self, seconds: float, n_tokens: int, streaming_seconds: float):
+        self.completion_latency.observe(seconds, model=self.model)
+        if streaming_seconds > 0:
+            self.tokens_per_second.observe(n_tokens / streaming_seconds, model=self.model)
+
+    def count_upstream_error(self, error_type: str):
+        self.upstream_errors.inc(model=self.model, type=error_type)
+
+    def observe_startup(self, step: str, seconds: float):
+        self.startup_latency.set(seconds, model=self.model, step=step)
+
+    def count_stream_frames(self, deltas_in: int, frames_out: int):
+        self.stream_deltas.inc(deltas_in, model=self.model)
+        self.stream_frames.inc(frames_out, model=self.model)
+
+    def render(self) -> str:
+        return self.registry.render()
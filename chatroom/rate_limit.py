@@ -0,0 +1,104 @@
+import time
+from typing import Dict, Optional, Tuple
+
+
+class TokenBucket(object):
+    """
+    refills `rate` units per second up to `capacity`, starting full
+    """
+    __slots__ = ('rate', 'capacity', 'level', 'stamp')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate: float = rate
+        self.capacity: float = capacity
+        self.level: float = capacity
+        self.stamp: float = time.monotonic()
+
+    def refill(self, now: float):
+        if now > self.stamp:
+            self.level = min(self.capacity, self.level + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def wait_time(self, amount: float) -> float:
+        """
+        seconds until `amount` can be taken, 0 if it can be right now
+        """
+        amount = min(amount, self.capacity)     # anything bigger than the bucket still gets through once it is full
+        if self.level >= amount:
+            return 0.
+        return (amount - self.level) / self.rate if self.rate > 0 else float('inf')
+
+    def take(self, amount: float):
+        self.level -= min(amount, self.capacity)
+
+
+class RateLimiter(object):
+    """
+    per-user token buckets, one counting requests and one counting (estimated) tokens
+    a request is let through only if both buckets can afford it, and then charged to both
+    """
+
+    def __init__(self,
+                 *,
+                 requests_per_minute: float = 10.,
+                 request_burst: int = 5,
+                 tokens_per_minute: float = 40000.,
+                 token_burst: int = 16000,
+                 ):
+        """
+
+        :param requests_per_minute: sustained request rate, 0 for no request limit
+        :param request_burst:       requests allowed back to back
+        :param tokens_per_minute:   sustained token rate, 0 for no token limit
+        :param token_burst:         tokens allowed back to back, should exceed the largest single request
+        """
+        self.requests_per_second: float = requests_per_minute / 60.
+        self.request_burst: int = request_burst
+        self.tokens_per_second: float = tokens_per_minute / 60.
+        self.token_burst: int = token_burst
+        self.buckets: Dict[str, Tuple[TokenBucket, TokenBucket]] = {}
+        self.n_rejected: int = 0
+
+    def _buckets(self, user: str) -> Tuple[TokenBucket, TokenBucket]:
+        buckets = self.buckets.get(user)
+        if buckets is None:
+            buckets = (TokenBucket(self.requests_per_second, self.request_burst),
+                       TokenBucket(self.tokens_per_second, self.token_burst))
+            self.buckets[user] = buckets
+        return buckets
+
+    def acquire(self, user: str, cost: float) -> Optional[float]:
+        """
+        charge one request of `cost` tokens to the user
+        returns None if accepted, or the seconds to wait before the request would be accepted
+        """
+        now = time.monotonic()
+        request_bucket, token_bucket = self._buckets(user)
+        request_bucket.refill(now)
+        token_bucket.refill(now)
+        wait = 0.
+        if self.requests_per_second > 0:
+            wait = max(wait, request_bucket.wait_time(1))
+        if self.tokens_per_second > 0:
+            wait = max(wait, token_bucket.wait_time(cost))
+        if wait > 0:
+            self.n_rejected += 1
+            return wait
+        if self.requests_per_second > 0:
+            request_bucket.take(1)
+        if self.tokens_per_second > 0:
+            token_bucket.take(cost)
+        self._prune(now)
+        return None
+
+    def _prune(self, now: float):
+        """
+        forget users whose buckets are back to full, they would be recreated identical
+        """
+        if len(self.buckets) < 1024:
+            return
+        for user, (request_bucket, token_bucket) in list(self.buckets.items()):
+            request_bucket.refill(now)
+            token_bucket.refill(now)
+            if request_bucket.level >= request_bucket.capacity and token_bucket.level >= token_bucket.capacity:
+                del self.buckets[user]
@@ -0,0 +1,108 @@
+import heapq
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Any, List, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+class CompletionScheduler(object):
+    """
+    runs completion jobs concurrently:
+        - at most `max_concurrency` jobs in flight across all users
+        - at most one job in flight per user, so each user's messages are answered in order
+        - free slots go to users by weighted fair queuing: every job is stamped with a virtual finish time,
+          max(virtual time, finish time of the user's previous job) + cost / weight, and the smallest goes first,
+          so a user sending many or large requests only delays their own later jobs, not the others
+    """
+
+    def __init__(self,
+                 *,
+                 handler: Callable[..., Awaitable[Any]],
+                 max_concurrency: int = 8,
+                 ):
+        """
+
+        :param handler:         coroutine function, called as handler(user, job)
+        :param max_concurrency: global limit of in-flight jobs
+        """
+        assert max_concurrency > 0, f"'max_concurrency' must be positive but received {max_concurrency}"
+        self.handler = handler
+        self.max_concurrency: int = max_concurrency
+        self.pending: Dict[str, Deque[Tuple[float, Any]]] = {}  # user -> (finish time, job) not started yet
+        self.ready: List[Tuple[float, int, str]] = []   # heap of (finish time of the head job, seq, user)
+        self.running: Dict[str, asyncio.Task] = {}
+        self.virtual_time: float = 0.
+        self.last_finish: Dict[str, float] = {}         # user -> finish time of the user's latest job
+        self.seq: int = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(jobs) for jobs in self.pending.values())
+
+    def _push_ready(self, user: str):
+        self.seq += 1
+        heapq.heappush(self.ready, (self.pending[user][0][0], self.seq, user))
+
+    def submit(self, user: str, job, *, cost: float = 1., weight: float = 1.) -> int:
+        """
+        returns the job's place in the queue, 1 for next in line, or 0 if it started right away
+        """
+        finish = max(self.virtual_time, self.last_finish.get(user, 0.)) + cost / weight
+        self.last_finish[user] = finish
+        jobs = self.pending.setdefault(user, deque())
+        jobs.append((finish, job))
+        if user not in self.running and len(jobs) == 1:
+            self._push_ready(user)
+        self._dispatch()
+        if user in self.pending and self.pending[user][-1][1] is job:
+            return self.position(finish)
+        return 0
+
+    def position(self, finish: float) -> int:
+        return 1 + sum(1 for jobs in self.pending.values() for _finish, _ in jobs if _finish < finish)
+
+    def cancel(self, user: str, *, drop_pending: bool = False) -> list:
+        """
+        cancel the user's job in flight, if any, which frees its slot right away
+        returns the jobs dropped from the queue, if `drop_pending`
+        """
+        dropped = []
+        if drop_pending and user in self.pending:
+            dropped = [job for _, job in self.pending.pop(user)]
+            self.last_finish.pop(user, None)
+        task = self.running.get(user)
+        if task is not None:
+            task.cancel()
+        return dropped
+
+    def _dispatch(self):
+        while self.ready and len(self.running) < self.max_concurrency:
+            finish, _, user = heapq.heappop(self.ready)
+            if user not in self.pending:    # jobs dropped by cancel()
+                continue
+            jobs = self.pending[user]
+            _, job = jobs.popleft()
+            if len(jobs) == 0:
+                del self.pending[user]
+            self.virtual_time = max(self.virtual_time, finish)
+            task = asyncio.ensure_future(self.handler(user, job))
+            self.running[user] = task
+            task.add_done_callback(lambda _task, _user=user: self._on_done(_user, _task))
+
+    def _on_done(self, user: str, task: asyncio.Task):
+        if self.running.get(user) is task:
+            del self.running[user]
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('job of %s failed', user, exc_info=task.exception())
+        if user in self.pending:
+            self._push_ready(user)
+        elif self.last_finish.get(user, 0.) <= self.virtual_time:
+            self.last_finish.pop(user, None)    # idle and caught up, would restart from the virtual time anyway
+        self._dispatch()
+
+    async def join(self):
+        while self.running:
+            await asyncio.gather(*self.running.values(), return_exceptions=True)
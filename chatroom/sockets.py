@@ -0,0 +1,236 @@
+import time
+import asyncio
+from collections import deque
+from typing import Callable, Deque, Dict, Literal, Optional, Union
+
+from fastapi import WebSocket
+from starlette.websockets import WebSocketState
+
+from .frames import Frame
+
+
+SlowConsumerPolicy = Literal['drop', 'coalesce', 'disconnect']
+Subscription = Literal['all', 'self']
+
+
+class ConnectionWriter(object):
+    """
+    bounded outbound queue of one websocket, drained by its own writer task on the server loop
+
+    when the queue is full, `policy` decides what happens to the new frame:
+        drop:       the frame is discarded
+        coalesce:   a streamed delta is merged into the latest queued delta of the same reply,
+                    frames that can not be merged are discarded
+        disconnect: the connection is closed
+    """
+
+    def __init__(self,
+                 websocket: WebSocket,
+                 *,
+                 max_queue: int = 1024,
+                 policy: SlowConsumerPolicy = 'coalesce',
+                 user: str = '',
+                 room: str = '',
+                 ):
+        assert policy in ['drop', 'coalesce', 'disconnect'], \
+            f"'policy' must be one of ['drop', 'coalesce', 'disconnect'] but received '{policy}'"
+        self.websocket: WebSocket = websocket
+        self.max_queue: int = max_queue
+        self.policy: SlowConsumerPolicy = policy
+        self.queue: Deque[Frame] = deque()
+        self.event = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.closed: bool = False
+        self.n_dropped: int = 0
+        self.n_coalesced: int = 0
+        self.user: str = user
+        self.room: str = room
+        self.subscription: Subscription = 'all'
+
+    def wants(self, frame: Frame) -> bool:
+        """
+        whether the frame is meant for this connection, frames of other rooms are never routed here
+        in 'self' mode the streamed deltas of replies to other users are left out, complete messages still come
+        """
+        if self.subscription == 'all' or not frame.is_delta:
+            return True
+        data = frame.data
+        return data.get('receiver', '') in ['', self.user] or data.get('sender', '') == self.user
+
+    def start(self):
+        self.task = asyncio.ensure_future(self._drain())
+
+    def _coalesce(self, frame: Frame) -> bool:
+        if not frame.is_delta:
+            return False
+        receiver = frame.data.get('receiver', '')
+        for i in range(len(self.queue) - 1, -1, -1):
+            queued = self.queue[i].data
+            if queued.get('receiver', '') != receiver:
+                continue
+            if queued.get('complete', True):
+                return False
+            self.queue[i] = Frame(dict(queued, message=queued.get('message', '') + frame.data.get('message', '')))
+            return True
+        return False
+
+    def put(self, frame: Frame) -> bool:
+        """
+        non-blocking, returns False if the connection is to be disconnected
+        """
+        if self.closed:
+            return True
+        if len(self.queue) >= self.max_queue:
+            if self.policy == 'disconnect':
+                return False
+            if self.policy == 'coalesce' and self._coalesce(frame):
+                self.n_coalesced += 1
+            else:
+                self.n_dropped += 1
+            return True
+        self.queue.append(frame)
+        self.event.set()
+        return True
+
+    async def _drain(self):
+        # noinspection PyBroadException
+        try:
+            while True:
+                while len(self.queue) == 0:
+                    self.event.clear()
+                    await self.event.wait()
+                frame = self.queue.popleft()
+                await self.websocket.send_text(frame.text)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # client is gone, the websocket handler takes care of the cleanup
+            self.closed = True
+
+    async def close(self):
+        self.closed = True
+        if self.task is not None:
+            self.task.cancel()
+        cond1 = self.websocket.application_state != WebSocketState.DISCONNECTED
+        cond2 = self.websocket.client_state != WebSocketState.DISCONNECTED
+        if cond1 and cond2:
+            await self.websocket.close()
+
+
+class SocketManager:
+    """
+    websocket registry and fan-out bus
+
+    broadcast()/publish() may be called from any thread or event loop, frames are handed over to the server loop
+    and queued per connection, so a slow client never holds up the others
+    a frame goes to the connections of its room only (to every room if the frame has none), minus the connections
+    whose subscription filters it out, see ConnectionWriter.wants
+    `relay`, if set, additionally receives every published frame, e.g. to forward it to other nodes
+    `metrics`, if set, is told how long each fan-out took with observe_fanout(seconds)
+    """
+
+    def __init__(self,
+                 *,
+                 max_queue: int = 1024,
+                 policy: SlowConsumerPolicy = 'coalesce',
+                 ):
+        self.active_connections: Dict[str, ConnectionWriter] = {}
+        self.rooms: Dict[str, Dict[str, ConnectionWriter]] = {}   # room -> user -> writer
+        self.max_queue: int = max_queue
+        self.policy: SlowConsumerPolicy = policy
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.relay: Optional[Callable[[Frame], None]] = None
+        self.metrics = None
+
+    def _register(self, writer: ConnectionWriter):
+        self.active_connections[writer.user] = writer
+        self.rooms.setdefault(writer.room, {})[writer.user] = writer
+
+    def _unregister(self, writer: ConnectionWriter):
+        del self.active_connections[writer.user]
+        members = self.rooms.get(writer.room, {})
+        if members.get(writer.user) is writer:
+            del members[writer.user]
+            if len(members) == 0:
+                del self.rooms[writer.room]
+
+    async def connect(self, *, user: str, websocket: WebSocket, room: str = '') -> bool:
+        self.loop = asyncio.get_running_loop()
+        await websocket.accept()
+        status = True
+        other_writer = None
+        if user in self.active_connections:
+            other_writer = self.active_connections[user]
+            self._unregister(other_writer)
+            status = False
+        writer = ConnectionWriter(websocket, max_queue=self.max_queue, policy=self.policy, user=user, room=room)
+        writer.start()
+        self._register(writer)
+        if other_writer is not None:
+            await other_writer.close()
+        return status
+
+    async def disconnect(self, *, user: str, websocket: WebSocket) -> bool:
+        if user in self.active_connections:
+            writer: ConnectionWriter = self.active_connections[user]
+            if websocket == writer.websocket:
+                self._unregister(writer)
+                await writer.close()
+                return True
+        return False
+
+    def subscribe(self, *, user: str, subscription: Subscription):
+        assert subscription in ['all', 'self'], \
+            f"'subscription' must be one of ['all', 'self'] but received '{subscription}'"
+        writer = self.active_connections.get(user)
+        if writer is not None:
+            writer.subscription = subscription
+
+    def room_of(self, user: str) -> Optional[str]:
+        writer = self.active_connections.get(user)
+        return writer.room if writer is not None else None
+
+    def _fanout(self, frame: Frame, published: Optional[float] = None):
+        room = frame.data.get('room', '')
+        if room:
+            writers = list(self.rooms.get(room, {}).values())
+        else:
+            writers = list(self.active_connections.values())
+        for writer in writers:
+            if writer.wants(frame) and not writer.put(frame):
+                asyncio.ensure_future(writer.close())
+        if self.metrics is not None and published is not None:
+            self.metrics.observe_fanout(time.perf_counter() - published)
+
+    def publish(self, data: Union[dict, Frame]):
+        frame = data if isinstance(data, Frame) else Frame(data)
+        if self.relay is not None:
+            self.relay(frame)
+        self.publish_local(frame)
+
+    def publish_local(self, frame: Frame):
+        loop = self.loop
+        if loop is None:    # nobody has connected yet
+            return
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        published = time.perf_counter() if self.metrics is not None else None
+        if running_loop is loop:
+            self._fanout(frame, published)
+        else:
+            loop.call_soon_threadsafe(self._fanout, frame, published)
+
+    async def broadcast(self, data: Union[dict, Frame]):
+        self.publish(data)
+
+    async def close_all(self):
+        """
+        closes every connection and its writer task, e.g. on shutdown, the next connect binds to its own loop
+        """
+        writers = list(self.active_connections.values())
+        for writer in writers:
+            self._unregister(writer)
+        await asyncio.gather(*[writer.close() for writer in writers], return_exceptions=True)
+        self.loop = None
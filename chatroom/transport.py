@@ -0,0 +1,154 @@
+import os
+import time
+import socket
+import asyncio
+import threading
+from collections import deque
+from functools import partial
+from typing import Deque, Dict, Optional, Tuple
+
+from redis import Redis
+from redis.exceptions import ResponseError
+
+
+class MessageTransport(object):
+    """
+    carries inbound chat messages from the websocket handlers to the ChatGPT consumer
+
+    put() may be called from any event loop, get() returns (message id, data) or None when nothing arrived in time,
+    every message returned by get() is to be ack()-ed once processed
+    """
+
+    async def put(self, data: Dict[str, str]):
+        raise NotImplementedError
+
+    async def get(self) -> Optional[Tuple[Optional[str], Dict[str, str]]]:
+        raise NotImplementedError
+
+    async def ack(self, msg_id: Optional[str]):
+        pass
+
+
+class LocalTransport(MessageTransport):
+    """
+    in-process asyncio queue, for single-process deployments, no serialization and no IPC
+    the queue lives on the consumer's loop, producers on other loops hand messages over thread-safely
+    """
+
+    def __init__(self):
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.queue: Optional[asyncio.Queue] = None
+        self.backlog: Deque[Dict[str, str]] = deque()   # messages put before the consumer started
+        self.lock = threading.Lock()
+
+    async def put(self, data: Dict[str, str]):
+        with self.lock:
+            if self.loop is None:
+                self.backlog.append(data)
+                return
+        if asyncio.get_running_loop() is self.loop:
+            self.queue.put_nowait(data)
+        else:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, data)
+
+    async def get(self) -> Optional[Tuple[Optional[str], Dict[str, str]]]:
+        if self.loop is None:
+            with self.lock:
+                self.loop = asyncio.get_running_loop()
+                self.queue = asyncio.Queue()
+                while self.backlog:
+                    self.queue.put_nowait(self.backlog.popleft())
+        data = await self.queue.get()
+        return None, data
+
+
+class RedisStreamTransport(MessageTransport):
+    """
+    redis stream read through a consumer group, used in cluster mode where the elected leader consumes and the
+    ClusterBus relays the reply frames to the worker the user is connected to
+    a message stays pending until ack()-ed, messages left pending by another, dead consumer for `claim_idle_ms` are
+    claimed by a live one
+    """
+
+    def __init__(self,
+                 redis: Redis,
+                 *,
+                 stream: str = 'msg_stream',
+                 group: str = 'chatgpt',
+                 consumer: Optional[str] = None,
+                 block_ms: int = 1000,
+                 claim_idle_ms: int = 60000,
+                 maxlen: int = 10000,
+                 ):
+        self.redis: Redis = redis
+        self.stream: str = stream
+        self.group: str = group
+        self.consumer: str = consumer if consumer is not None else f'{socket.gethostname()}-{os.getpid()}'
+        self.block_ms: int = block_ms
+        self.claim_idle_ms: int = claim_idle_ms
+        self.maxlen: int = maxlen
+        self.claimed: Deque[Tuple[str, Dict[str, str]]] = deque()
+        self.last_claim: float = 0.
+        self.group_ready: bool = False
+
+    @staticmethod
+    def decode(msg_id: bytes, fields: Dict[bytes, bytes]) -> Tuple[str, Dict[str, str]]:
+        return msg_id.decode(), {key.decode(): value.decode() for key, value in fields.items()}
+
+    def _ensure_group(self):
+        if self.group_ready:
+            return
+        try:
+            self.redis.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+        except ResponseError as err:
+            if 'BUSYGROUP' not in str(err):
+                raise
+        self.group_ready = True
+
+    def _claim(self):
+        """
+        claims the messages left idle for `claim_idle_ms` by other consumers, never its own, which are still queued
+        or being answered here however long that takes
+        """
+        self.last_claim = time.monotonic()
+        start = '-'
+        while True:
+            pending = self.redis.xpending_range(self.stream, self.group, min=start, max='+', count=100,
+                                                idle=self.claim_idle_ms)
+            msg_ids = [entry['message_id'] for entry in pending if entry['consumer'].decode() != self.consumer]
+            if msg_ids:
+                for msg_id, fields in self.redis.xclaim(self.stream, self.group, self.consumer,
+                                                        self.claim_idle_ms, msg_ids):
+                    if fields:  # entries trimmed from the stream come back empty
+                        self.claimed.append(self.decode(msg_id, fields))
+            if len(pending) < 100:
+                break
+            start = '(' + pending[-1]['message_id'].decode()
+
+    def _read(self) -> Optional[Tuple[str, Dict[str, str]]]:
+        self._ensure_group()
+        if time.monotonic() - self.last_claim > self.claim_idle_ms / 1000.:
+            self._claim()
+        if self.claimed:
+            return self.claimed.popleft()
+        result = self.redis.xreadgroup(self.group, self.consumer, {self.stream: '>'}, count=1, block=self.block_ms)
+        if not result:
+            return None
+        _, messages = result[0]
+        msg_id, fields = messages[0]
+        return self.decode(msg_id, fields)
+
+    async def put(self, data: Dict[str, str]):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, partial(self.redis.xadd, self.stream, data,
+                                                 maxlen=self.maxlen, approximate=True))
+
+    async def get(self) -> Optional[Tuple[Optional[str], Dict[str, str]]]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._read)
+
+    async def ack(self, msg_id: Optional[str]):
+        if msg_id is None:
+            return
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.redis.xack, self.stream, self.group, msg_id)
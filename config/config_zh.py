@@ -7,8 +7,17 @@ class Args:
     """
     CACHE_DIR: str = './cache'
     REDIS_PATH: str = './cache/redis/redis.db'
-    REDIS_MSG_QUEUE: str = 'msg_queue'
+    MSG_TRANSPORT: str = 'local'            # 'local' in-process queue, or 'redis' stream, with CLUSTER_MODE only
+    REDIS_MSG_STREAM: str = 'msg_stream'
+    REDIS_MSG_GROUP: str = 'chatgpt'
+    REDIS_CONTEXT_PREFIX: str = 'context:'
+    TOKENIZER_DIR: str = './tokenizer'      # prebuilt with `python -m chatgpt_api.tokenizer`, no download at runtime
     PROMPTS_DIR: str = './prompts/prompts_zh'
+    PROMPT_CHECK_INTERVAL: float = 2.       # seconds between checks of the prompt files for edits, SIGHUP reloads now
+    LOG_LEVEL: str = 'info'                 # 'debug', 'info', 'warning' or 'error'
+    LOG_TOKENS: bool = False                # include prompts and replies in the log, off in production
+    LOG_MAX_BYTES: int = 10 * 1024 * 1024   # log files under CACHE_DIR/log rotate at this size
+    LOG_BACKUP_COUNT: int = 5
 
     """
     chatgpt variables
@@ -18,11 +27,52 @@ class Args:
     DEBUG_KEY: str = 'CHATGPT_CHATROOM_SERVER_DEBUG'
     CHATGPT_WAKING_PATTERN = re.compile(r'@chatgpt', re.IGNORECASE)
     CHATGPT_TEXT_COLOR = '#DE3163'
+    CHATGPT_MODEL: str = 'gpt-3.5-turbo-0301'  # or 'gpt-3.5-turbo'
+    MAX_CONCURRENT_COMPLETIONS: int = 8     # global limit of replies streamed at the same time
+    CONTEXT_SOFT_WATERMARK: float = 0.75    # share of the token budget above which contexts get summarized in background
+    CONTEXT_CONSOLIDATE_MODE: str = 'summarize'     # or 'sliding_window', dropping old messages without API calls
+    TOKEN_CACHE_SIZE: int = 16384           # distinct messages whose token count is kept, above the live messages
+    TOKENIZER_THREADS: int = 1              # token counting runs on its own threads, off the event loop
+    TOKENIZER_PROCESSES: int = 0            # process pool for very large pastes, 0 to count them in threads too
+    TOKENIZER_PROCESS_THRESHOLD: int = 100000   # characters from which a message goes to the process pool
+    CONTEXT_MAX_USER_BYTES: int = 256 * 1024        # per user, oldest messages are dropped beyond it
+    CONTEXT_MAX_HOT_BYTES: int = 64 * 1024 * 1024   # in-memory contexts in total, none in CLUSTER_MODE
+    CONTEXT_IDLE_TTL: int = 3600            # seconds before an untouched context is evicted
+    CONTEXT_RESET_ON_CONNECT: bool = True   # start over on every page load, False to resume stored contexts
+    OPENAI_API_BASE: str = 'https://api.openai.com/v1'
+    OPENAI_HTTP2: bool = False              # requires the 'h2' package
+    MAX_UPSTREAM_CONNECTIONS: int = 100     # keep-alive connection pool size
+    STREAM_COALESCE_WINDOW_MS: float = 40.  # join streamed deltas into one frame per window, 0 to disable
+    STREAM_COALESCE_MAX_BYTES: int = 512    # flush early once this many bytes are buffered
+    CHATGPT_TEMPERATURE: float = 1.         # 0.0 ~ 1.0
+    RESPONSE_CACHE: bool = True             # replay identical questions, only active at temperature 0 unless below
+    RESPONSE_CACHE_NONDETERMINISTIC: bool = False   # cache at any temperature
+    RESPONSE_CACHE_BACKEND: str = 'memory'  # or 'redis' to share among workers
+    RESPONSE_CACHE_SIZE: int = 1024
+    RESPONSE_CACHE_TTL: int = 3600          # seconds
+    RESPONSE_CACHE_ACROSS_USERS: bool = False   # share replies among users, the "user: <name>" line is then not sent
+    RESPONSE_REPLAY_CPS: float = 400.       # characters per second when streaming a cached reply, 0 for instant
+    SINGLE_FLIGHT: bool = False             # identical requests of different users share one upstream stream,
+                                            # requires RESPONSE_CACHE_ACROSS_USERS
+    RATE_LIMIT_REQUESTS_PER_MIN: float = 10.    # per user, 0 for no limit
+    RATE_LIMIT_REQUEST_BURST: int = 5
+    RATE_LIMIT_TOKENS_PER_MIN: float = 40000.   # per user, estimated from the context, 0 for no limit
+    RATE_LIMIT_TOKEN_BURST: int = 16000     # above the largest single request
 
     """
     other variables
     """
     PING_HOST = 'www.sina.com.cn'
+    WS_SEND_QUEUE_SIZE: int = 1024          # outbound frames buffered per websocket
+    WS_SLOW_CONSUMER_POLICY: str = 'coalesce'   # 'drop', 'coalesce' or 'disconnect' when the buffer is full
+    CLUSTER_MODE: bool = False              # several workers / nodes sharing one room, with MSG_TRANSPORT = 'redis'
+    CLUSTER_CHANNEL: str = 'room_frames'    # redis pub/sub channel relaying broadcasts
+    PRESENCE_TTL: int = 30                  # seconds before users of a dead worker are considered offline
+    LEADER_TTL_MS: int = 10000              # lease of the worker running ChatGPT
+    DEFAULT_ROOM: str = 'lobby'             # room of /chat without ?room=name
+    ROOM_NAME_PATTERN = re.compile(r'[\w-]{1,32}')
+    STARTUP_BUDGET: float = 10.             # seconds, a warning is logged when the warm-up takes longer
+    DRAIN_TIMEOUT: float = 30.              # seconds given to replies in flight on shutdown before they are stopped
 
     """
     server message variables
@@ -32,6 +82,9 @@ class Args:
     ENTER_ROOM_MSG = '进入聊天室 当前人数'
     EXIT_ROOM_MSG = '退出聊天室   当前人数'
     EMPTY_INPUT_MSG = '【您的输入为空，请重新输入】'
+    QUEUED_MSG = '【排队中，当前第 {} 位】'
+    RATE_LIMITED_MSG = '【请求过于频繁，请 {} 秒后重试】'
+    STOPPED_MSG = ' 【已停止】'
 
     """
     client web variables
@@ -44,7 +97,9 @@ class Args:
     SHOW_SELF = '仅显示自己'
     REALTIME_PANEL = '实时面板'
     CURRENT_USER = '当前用户'
+    CURRENT_ROOM = '房间'
     DISCONNECT_MSG = '\\n【您已与服务器断开，请尝试刷新页面，或重新登入】\\n'
     TEXT_INPUT_HINT = '输入聊天内容， 可以@chatgpt，shift+回车换行，刷新页面重置上下文'
     SEND_BUTTON = '发送'
+    STOP_BUTTON = '停止'
     COPY_ALERT = '已复制到剪贴板'
@@ -3,11 +3,16 @@ pip3 install -U pip setuptools
 pip3 install colorama==0.4.6
 pip3 install psutil==5.9.4
 pip3 install tqdm==4.64.1
-pip3 install fastapi==0.88.0
+pip3 install fastapi==0.95.0
 pip3 install uvicorn==0.20.0
 pip3 install Jinja2==3.1.2
 pip3 install websockets==10.4
 pip3 install redislite==6.2.805324
+pip3 install orjson==3.8.7
 
 pip3 install openai==0.27.0
 pip3 install tiktoken==0.2.0
+pip3 install httpx[http2]==0.23.3
+
+# tokenizer files, loaded offline by the server
+python3 -m chatgpt_api.tokenizer
@@ -1,14 +1,14 @@
 import os
 import re
-import builtins
-from functools import partial
-import traceback
-import pickle
 import time
-from typing import List, Dict, Union
+import logging
+from typing import List, Dict, Tuple, Optional
 import json
+import signal
 
 import threading
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor, Future
 import redislite
 from redislite.client import Redis
 from redis.exceptions import ConnectionError
@@ -22,90 +22,59 @@ from fastapi import (
     Request,
     Response
 )
-from starlette.websockets import WebSocketState
+from fastapi.responses import PlainTextResponse, JSONResponse
+from starlette.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
-from chatgpt_api import time_now_str
+from chatgpt_api import (
+    time_now_str,
+    ResponseCache,
+    Message,
+    SYSTEM,
+    check_tokenizer_assets,
+    TokenizerAssetError
+)
+from chatroom import (
+    CompletionScheduler,
+    RateLimiter,
+    ChatMetrics,
+    setup_logging,
+    stop_logging,
+    SocketManager,
+    DeltaCoalescer,
+    ContextCompactor,
+    ContextStore,
+    LocalTransport,
+    RedisStreamTransport,
+    ClusterBus,
+    Presence,
+    LeaderElection,
+    create_response
+)
 from colorama import Fore, Style
 
 from config.config_en import Args
 # from config.config_zh import Args
 
 
-builtins.print = partial(print, flush=True)
-
-
-class SocketManager:
-    def __init__(self):
-        self.active_connections: Dict[str: List[WebSocket]] = {}
-
-    async def connect(self, *, user: str, websocket: WebSocket) -> bool:
-        await websocket.accept()
-        status = True
-        other_websocket = None
-        if user in self.active_connections:
-            other_websocket = self.active_connections[user]
-            status = False
-        self.active_connections[user] = websocket
-        if other_websocket is not None:
-            await other_websocket.close()
-        return status
-
-    async def disconnect(self, *, user: str, websocket: WebSocket) -> bool:
-        if user in self.active_connections:
-            _websocket: WebSocket = self.active_connections[user]
-            if websocket == _websocket:
-                cond1 = websocket.application_state != WebSocketState.DISCONNECTED
-                cond2 = websocket.client_state != WebSocketState.DISCONNECTED
-                if cond1 and cond2:
-                    await websocket.close()
-                del self.active_connections[user]
-                return True
-        return False
-
-    async def broadcast(self, data: dict):
-        for user, connection in self.active_connections.items():
-            await connection.send_json(data)
-
-
-def create_response(
-        message: str = "",
-        *,
-        time_str: str = "",
-        sender: str = "",
-        receiver: str = "",
-        italic: bool = False,
-        strong: bool = False,
-        color: str = "",
-        complete: bool = True,
-):
-    response = {
-        "time_str": time_str,
-        "sender": sender,
-        "receiver": receiver,
-        "message": message,
-        "italic": italic,
-        "strong": strong,
-        "color": color,
-        "complete": complete,
-    }
-    return response
-
-
 """
 path variables
 """
 CACHE_DIR: str = Args.CACHE_DIR
 REDIS_PATH: str = Args.REDIS_PATH
-REDIS_MSG_QUEUE: str = Args.REDIS_MSG_QUEUE
+MSG_TRANSPORT: str = Args.MSG_TRANSPORT
+REDIS_MSG_STREAM: str = Args.REDIS_MSG_STREAM
+REDIS_MSG_GROUP: str = Args.REDIS_MSG_GROUP
+REDIS_CONTEXT_PREFIX: str = Args.REDIS_CONTEXT_PREFIX
+TOKENIZER_DIR: str = Args.TOKENIZER_DIR
 PROMPTS_DIR: str = Args.PROMPTS_DIR
-
-os.makedirs(CACHE_DIR, exist_ok=True)
-os.makedirs(os.path.join(CACHE_DIR, 'log'), exist_ok=True)    # TODO: logging not implemented yet
-os.makedirs(os.path.join(CACHE_DIR, 'redis'), exist_ok=True)
-os.makedirs(os.path.dirname(REDIS_PATH), exist_ok=True)
-redis: Redis = redislite.Redis(REDIS_PATH)
+PROMPT_CHECK_INTERVAL: float = Args.PROMPT_CHECK_INTERVAL
+LOG_LEVEL: str = Args.LOG_LEVEL
+LOG_TOKENS: bool = Args.LOG_TOKENS
+LOG_MAX_BYTES: int = Args.LOG_MAX_BYTES
+LOG_BACKUP_COUNT: int = Args.LOG_BACKUP_COUNT
+logger = logging.getLogger('chatroom.server')
 
 
 """
@@ -116,24 +85,72 @@ ENV_ORG_ID: str = Args.ENV_ORG_ID
 DEBUG_KEY: str = Args.DEBUG_KEY
 CHATGPT_WAKING_PATTERN = Args.CHATGPT_WAKING_PATTERN
 CHATGPT_TEXT_COLOR = Args.CHATGPT_TEXT_COLOR
-
-if DEBUG_KEY in os.environ and str(os.environ[DEBUG_KEY]).lower() in ['1', 'true']:
-    API_KEY: str = ''
-    API_ORG: str = ''
-    CHATGPT_DEBUG_MODE = True
-else:
+CHATGPT_MODEL: str = Args.CHATGPT_MODEL
+MAX_CONCURRENT_COMPLETIONS: int = Args.MAX_CONCURRENT_COMPLETIONS
+CONTEXT_SOFT_WATERMARK: float = Args.CONTEXT_SOFT_WATERMARK
+CONTEXT_CONSOLIDATE_MODE: str = Args.CONTEXT_CONSOLIDATE_MODE
+TOKEN_CACHE_SIZE: int = Args.TOKEN_CACHE_SIZE
+TOKENIZER_THREADS: int = Args.TOKENIZER_THREADS
+TOKENIZER_PROCESSES: int = Args.TOKENIZER_PROCESSES
+TOKENIZER_PROCESS_THRESHOLD: int = Args.TOKENIZER_PROCESS_THRESHOLD
+OPENAI_API_BASE: str = Args.OPENAI_API_BASE
+OPENAI_HTTP2: bool = Args.OPENAI_HTTP2
+MAX_UPSTREAM_CONNECTIONS: int = Args.MAX_UPSTREAM_CONNECTIONS
+CHATGPT_TEMPERATURE: float = Args.CHATGPT_TEMPERATURE
+RESPONSE_CACHE: bool = Args.RESPONSE_CACHE
+RESPONSE_CACHE_BACKEND: str = Args.RESPONSE_CACHE_BACKEND
+RESPONSE_CACHE_SIZE: int = Args.RESPONSE_CACHE_SIZE
+RESPONSE_CACHE_TTL: int = Args.RESPONSE_CACHE_TTL
+RESPONSE_CACHE_NONDETERMINISTIC: bool = Args.RESPONSE_CACHE_NONDETERMINISTIC
+RESPONSE_CACHE_ACROSS_USERS: bool = Args.RESPONSE_CACHE_ACROSS_USERS
+RESPONSE_REPLAY_CPS: float = Args.RESPONSE_REPLAY_CPS
+SINGLE_FLIGHT: bool = Args.SINGLE_FLIGHT
+RATE_LIMIT_REQUESTS_PER_MIN: float = Args.RATE_LIMIT_REQUESTS_PER_MIN
+RATE_LIMIT_REQUEST_BURST: int = Args.RATE_LIMIT_REQUEST_BURST
+RATE_LIMIT_TOKENS_PER_MIN: float = Args.RATE_LIMIT_TOKENS_PER_MIN
+RATE_LIMIT_TOKEN_BURST: int = Args.RATE_LIMIT_TOKEN_BURST
+
+CHATGPT_DEBUG_MODE: bool = DEBUG_KEY in os.environ and str(os.environ[DEBUG_KEY]).lower() in ['1', 'true']
+CONTEXT_MAX_USER_BYTES: int = Args.CONTEXT_MAX_USER_BYTES
+CONTEXT_MAX_HOT_BYTES: int = Args.CONTEXT_MAX_HOT_BYTES
+CONTEXT_IDLE_TTL: int = Args.CONTEXT_IDLE_TTL
+CONTEXT_RESET_ON_CONNECT: bool = Args.CONTEXT_RESET_ON_CONNECT
+
+
+def api_credentials() -> Tuple[str, str]:
+    """
+    api key and organization from the environment, checked on startup so a bad deployment fails right away
+    """
+    if CHATGPT_DEBUG_MODE:
+        return '', ''
     for var_key in [ENV_API_KEY, ENV_ORG_ID]:
         if var_key not in os.environ:
             raise ValueError(f'{Fore.RED}environmental variable "{var_key}" not provided{Style.RESET_ALL}')
-    API_KEY = str(os.environ[ENV_API_KEY])
-    API_ORG = str(os.environ[ENV_ORG_ID])
-    CHATGPT_DEBUG_MODE: bool = False
-user_context_dict: Dict[str, Union[None, List]] = {}
+    return str(os.environ[ENV_API_KEY]), str(os.environ[ENV_ORG_ID])
+
 
 """
 other variables
 """
 PING_HOST = Args.PING_HOST
+WS_SEND_QUEUE_SIZE: int = Args.WS_SEND_QUEUE_SIZE
+WS_SLOW_CONSUMER_POLICY: str = Args.WS_SLOW_CONSUMER_POLICY
+CLUSTER_MODE: bool = Args.CLUSTER_MODE
+CLUSTER_CHANNEL: str = Args.CLUSTER_CHANNEL
+PRESENCE_TTL: int = Args.PRESENCE_TTL
+LEADER_TTL_MS: int = Args.LEADER_TTL_MS
+DEFAULT_ROOM: str = Args.DEFAULT_ROOM
+ROOM_NAME_PATTERN = Args.ROOM_NAME_PATTERN
+STARTUP_BUDGET: float = Args.STARTUP_BUDGET
+DRAIN_TIMEOUT: float = Args.DRAIN_TIMEOUT
+if SINGLE_FLIGHT and not RESPONSE_CACHE_ACROSS_USERS:
+    # the key of every request holds the user's name otherwise, no two users could ever share a stream
+    raise ValueError(f"{Fore.RED}SINGLE_FLIGHT requires RESPONSE_CACHE_ACROSS_USERS{Style.RESET_ALL}")
+if CLUSTER_MODE != (MSG_TRANSPORT == 'redis'):
+    # without the cluster, each worker would take jobs of users connected to another and answer no one
+    raise ValueError(f"{Fore.RED}CLUSTER_MODE and MSG_TRANSPORT = 'redis' go together{Style.RESET_ALL}")
+STREAM_COALESCE_WINDOW_MS: float = Args.STREAM_COALESCE_WINDOW_MS
+STREAM_COALESCE_MAX_BYTES: int = Args.STREAM_COALESCE_MAX_BYTES
 
 """
 server message variables
@@ -143,6 +160,9 @@ UNKNOWN_NETWORK_ERR_MSG = Args.UNKNOWN_NETWORK_ERR_MSG
 ENTER_ROOM_MSG = Args.ENTER_ROOM_MSG
 EXIT_ROOM_MSG = Args.EXIT_ROOM_MSG
 EMPTY_INPUT_MSG = Args.EMPTY_INPUT_MSG
+QUEUED_MSG = Args.QUEUED_MSG
+RATE_LIMITED_MSG = Args.RATE_LIMITED_MSG
+STOPPED_MSG = Args.STOPPED_MSG
 
 """
 client web variables
@@ -155,19 +175,51 @@ SHOW_ALL = Args.SHOW_ALL
 SHOW_SELF = Args.SHOW_SELF
 REALTIME_PANEL = Args.REALTIME_PANEL
 CURRENT_USER = Args.CURRENT_USER
+CURRENT_ROOM = Args.CURRENT_ROOM
 DISCONNECT_MSG = Args.DISCONNECT_MSG
 TEXT_INPUT_HINT = Args.TEXT_INPUT_HINT
 SEND_BUTTON = Args.SEND_BUTTON
+STOP_BUTTON = Args.STOP_BUTTON
 COPY_ALERT = Args.COPY_ALERT
 
 
 """
 fastapi variables
 """
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    await services.start()
+    try:
+        yield
+    finally:
+        await services.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
-websocket_manager = SocketManager()   # websocket manager
+websocket_manager = SocketManager(max_queue=WS_SEND_QUEUE_SIZE, policy=WS_SLOW_CONSUMER_POLICY)   # websocket manager
+metrics = ChatMetrics(model=CHATGPT_MODEL)
+metrics.watch_connections(lambda: len(websocket_manager.active_connections))
+websocket_manager.metrics = metrics
+
+
+async def online_users() -> set:
+    if services.presence is not None:
+        return await services.presence.users_async()
+    return set(websocket_manager.active_connections.keys())
+
+
+def is_online(user: str) -> bool:
+    if services.presence is not None:
+        return services.presence.is_online(user)
+    return user in websocket_manager.active_connections
+
+
+def room_name(room) -> str:
+    if room and re.fullmatch(ROOM_NAME_PATTERN, room):
+        return room
+    return DEFAULT_ROOM
 
 
 @app.get("/")
@@ -183,7 +235,7 @@ def get_home(request: Request):
 
 
 @app.get("/chat")
-def get_chat(request: Request):
+def get_chat(request: Request, room: str = DEFAULT_ROOM):
     param = {
         "request": request,
         "roomName": CHAT_ROOM_NAME,
@@ -192,14 +244,32 @@ def get_chat(request: Request):
         "chatgptColor": CHATGPT_TEXT_COLOR,
         "realtimePanel": REALTIME_PANEL,
         "currentUser": CURRENT_USER,
+        "currentRoom": CURRENT_ROOM,
+        "room": room_name(room),
         "disconnectMsg": DISCONNECT_MSG,
         "textHint": TEXT_INPUT_HINT,
         "sendButton": SEND_BUTTON,
+        "stopButton": STOP_BUTTON,
         "copyAlert": COPY_ALERT,
     }
     return templates.TemplateResponse("chat.html", param)
 
 
+@app.get("/metrics")
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type=metrics.registry.CONTENT_TYPE)
+
+
+@app.get("/ready")
+def get_ready():
+    """
+    readiness probe, 503 while warming up, after a failed warm-up and while draining on shutdown
+    """
+    status = services.status()
+    return JSONResponse({'status': status, 'startup': services.startup_times},
+                        status_code=200 if status == 'ready' else 503)
+
+
 @app.get("/api/current_user")
 def get_user(request: Request):
     uname = ''
@@ -208,7 +278,7 @@ def get_user(request: Request):
     try:
         uname = json.loads(request.cookies.get("X-Authorization"))
     except Exception:
-        print('fail to decode uname from X-Authorization...')
+        logger.warning('fail to decode uname from X-Authorization...')
     return uname
 
 
@@ -220,9 +290,10 @@ class RegisterValidator(BaseModel):
 
 
 @app.post("/api/register")
-def register_user(user: RegisterValidator, response: Response):
+async def register_user(user: RegisterValidator, response: Response):
+    await services.wait_ready()
     uname = user.username
-    if uname in user_context_dict or uname.lower() == 'chatgpt':
+    if await run_in_threadpool(is_online, uname) or uname.lower() == 'chatgpt':
         return {'status': False}
 
     uname = json.dumps(uname)
@@ -235,60 +306,98 @@ async def chat(websocket: WebSocket):
     uname = websocket.cookies.get("X-Authorization")
 
     if uname:
+        await services.wait_ready()
         uname = json.loads(uname)
-        status = await websocket_manager.connect(user=uname, websocket=websocket)
+        room = room_name(websocket.query_params.get('room'))
+        status = await websocket_manager.connect(user=uname, websocket=websocket, room=room)
         if status:
-            user_context_dict[uname] = None
-            enter_room_txt = f"{uname} {ENTER_ROOM_MSG} {len(user_context_dict)}"
-            response = create_response(enter_room_txt, italic=True)
-            print(f"[{time_now_str()}] {enter_room_txt}")
-            print('users:', set(user_context_dict.keys()))
+            if services.presence is not None:
+                await services.presence.join_async(uname)
+            if CONTEXT_RESET_ON_CONNECT:
+                await services.context_store.delete_async(uname)
+            users = await online_users()
+            enter_room_txt = f"{uname} {ENTER_ROOM_MSG} {len(users)}"
+            response = create_response(enter_room_txt, italic=True, room=room)
+            logger.info(enter_room_txt, extra={'user': uname, 'room': room, 'online': len(users)})
             await websocket_manager.broadcast(response)
         try:
             while True:
                 data = await websocket.receive_json()
+                if data.get('control') == 'stop':
+                    await services.message_transport.put({'sender': uname, 'control': 'stop'})
+                    continue
+                if data.get('control') == 'subscribe':
+                    websocket_manager.subscribe(user=uname, subscription=data.get('subscription', 'all'))
+                    continue
                 _response = create_response(
                     time_str=f"{time_now_str()}",
                     sender=f"{uname}",
                     message=f"{data['message']}",
+                    room=room,
                 )
                 await websocket_manager.broadcast(_response)
-                redis.lpush(
-                    REDIS_MSG_QUEUE,
-                    pickle.dumps(
-                        {
-                            'sender': uname,
-                            'message': data['message'],
-                        }
-                    )
+                await services.message_transport.put(
+                    {
+                        'sender': uname,
+                        'message': f"{data['message']}",
+                        'room': room,
+                    }
                 )
         except WebSocketDisconnect:
             pass
         finally:
             status = await websocket_manager.disconnect(user=uname, websocket=websocket)
             if status:
-                # remove user context
-                if uname in user_context_dict:
-                    del user_context_dict[uname]
+                if not services.draining:   # set by Services.stop, the replies in flight are drained instead
+                    # noinspection PyBroadException
+                    try:
+                        await services.message_transport.put({'sender': uname, 'control': 'disconnect'})
+                    except Exception:
+                        logger.exception('failed to queue the disconnect of %s', uname)
+                if services.presence is not None:
+                    await services.presence.leave_async(uname)
+                # remove user context, unless it is kept for the next session or the reply is still being drained
+                if CONTEXT_RESET_ON_CONNECT and not services.draining:
+                    await services.context_store.delete_async(uname)
 
                 # noinspection PyBroadException
                 try:
-                    leave_room_txt = f"{uname} {EXIT_ROOM_MSG} {len(user_context_dict)}"
-                    response = create_response(leave_room_txt, italic=True)
-                    print(f"[{time_now_str()}] {leave_room_txt}")
-                    print('users:', set(user_context_dict.keys()))
+                    users = await online_users()
+                    leave_room_txt = f"{uname} {EXIT_ROOM_MSG} {len(users)}"
+                    response = create_response(leave_room_txt, italic=True, room=room)
+                    logger.info(leave_room_txt, extra={'user': uname, 'room': room, 'online': len(users)})
                     await websocket_manager.broadcast(response)
                 except Exception:
                     pass
 
 
-class ChatGPTThread(threading.Thread):
-    def __init__(self, *args, **kwargs):
+class ChatGPTConsumer(object):
+    """
+    reads the messages for ChatGPT on the server loop and schedules the replies
+    """
+
+    def __init__(self, chatgpt):
         self.uname = 'ChatGPT'
-        super().__init__(target=self.main, *args, **kwargs)
+        self.chatgpt = chatgpt
+        self.compactor = ContextCompactor(chatgpt)
+        scheduler = CompletionScheduler(handler=self.respond, max_concurrency=MAX_CONCURRENT_COMPLETIONS)
+        self.scheduler = scheduler
+        metrics.watch_queue_depth(lambda: scheduler.queue_depth)
+        self.rate_limiter = RateLimiter(
+            requests_per_minute=RATE_LIMIT_REQUESTS_PER_MIN,
+            request_burst=RATE_LIMIT_REQUEST_BURST,
+            tokens_per_minute=RATE_LIMIT_TOKENS_PER_MIN,
+            token_burst=RATE_LIMIT_TOKEN_BURST,
+        )
+        self.leadership: Optional[asyncio.Task] = None
+        self.cancel_reasons: Dict[str, str] = {}    # user -> 'stop' or 'disconnect', for the reply being cancelled
+        self.rooms: Dict[str, str] = {}     # user -> room the user last wrote from, where replies go
 
     @staticmethod
-    def launch_chatgpt():
+    def launch_chatgpt(*, api_key: str, api_org: str):
+        """
+        blocking, loads the tokenizer, the response cache is set once the store is up, see Services.warm_up
+        """
         # noinspection PyBroadException
         try:
             if not CHATGPT_DEBUG_MODE:
@@ -297,19 +406,48 @@ class ChatGPTThread(threading.Thread):
                 from chatgpt_api import ChatGPTDebug as ChatGPT
 
             chatgpt = ChatGPT(
-                api_key=API_KEY,
-                api_org=API_ORG,
+                api_key=api_key,
+                api_org=api_org,
                 prompts_dir=PROMPTS_DIR,
+                prompt_check_interval=PROMPT_CHECK_INTERVAL,
+                tokenizer_dir=TOKENIZER_DIR,
+                token_cache_size=TOKEN_CACHE_SIZE,
+                tokenizer_threads=TOKENIZER_THREADS,
+                tokenizer_processes=TOKENIZER_PROCESSES,
+                tokenizer_process_threshold=TOKENIZER_PROCESS_THRESHOLD,
+                model_name=CHATGPT_MODEL,
                 network_err_text=UNKNOWN_NETWORK_ERR_MSG,
+                api_base=OPENAI_API_BASE,
+                http2=OPENAI_HTTP2,
+                max_connections=MAX_UPSTREAM_CONNECTIONS,
+                soft_watermark=CONTEXT_SOFT_WATERMARK,
+                consolidate_mode=CONTEXT_CONSOLIDATE_MODE,
+                temperature=CHATGPT_TEMPERATURE,
+                cache_nondeterministic=RESPONSE_CACHE_NONDETERMINISTIC,
+                cache_key_filter=ChatGPTConsumer.is_shared_message if RESPONSE_CACHE_ACROSS_USERS else None,
+                replay_chars_per_second=RESPONSE_REPLAY_CPS,
+                single_flight=SINGLE_FLIGHT,
+                metrics=metrics,
             )
 
-            print(f'chatgpt launched')
-            print(f'--------------------------\n')
+            logger.info('chatgpt launched', extra={'model': chatgpt.model_name, 'debug': CHATGPT_DEBUG_MODE})
             return chatgpt
+        except TokenizerAssetError:
+            raise
         except Exception:
-            traceback.print_exc()
+            logger.exception('failed to launch chatgpt')
             raise ValueError(f"{Fore.RED}check env OPENAI_API_KEY and OPENAI_ORG_ID{Style.RESET_ALL}")
 
+    @staticmethod
+    def create_response_cache(redis: Redis) -> Optional[ResponseCache]:
+        if not RESPONSE_CACHE:
+            return None
+        return ResponseCache(
+            maxsize=RESPONSE_CACHE_SIZE,
+            ttl=RESPONSE_CACHE_TTL,
+            redis=redis if RESPONSE_CACHE_BACKEND == 'redis' else None,
+        )
+
     @staticmethod
     def is_asking_for_response(text: str):
         res = re.findall(re.compile(r'@chatgpt', re.IGNORECASE), text)
@@ -329,24 +467,46 @@ class ChatGPTThread(threading.Thread):
             asking_for_response: bool = False
         return sender, text, asking_for_response
 
-    async def alert_empty_input(self, receiver: str):
-        response = create_response(f"{EMPTY_INPUT_MSG}",
+    async def alert(self, receiver: str, message: str):
+        response = create_response(f"{message}",
                                    time_str=f"{time_now_str()}",
                                    sender=f"{self.uname}",
                                    receiver=f"{receiver}",
-                                   color=CHATGPT_TEXT_COLOR)
+                                   color=CHATGPT_TEXT_COLOR,
+                                   room=self.room_of(receiver))
         await websocket_manager.broadcast(response)
 
+    async def alert_empty_input(self, receiver: str):
+        await self.alert(receiver, EMPTY_INPUT_MSG)
+
+    async def estimate_cost(self, *, user: str, text: str) -> int:
+        """
+        tokens the request is expected to use: its context as it stands, the new message and the reply
+        """
+        chatgpt = self.chatgpt
+        context = await self.get_user_context(chatgpt=chatgpt, user=user) + chatgpt.create_context(text)
+        return sum(await chatgpt.count_context_tokens_async(context)) + chatgpt.min_reply_tokens
+
     @staticmethod
-    def get_user_context(*, chatgpt, user: str):
-        context = user_context_dict[user] if user in user_context_dict else None
+    async def get_user_context(*, chatgpt, user: str):
+        context = await services.context_store.get_async(user)
         if context is None:
             context = [
-                {'role': 'system', 'content': chatgpt.get_prompt('chat-agent.txt')},
-                {'role': 'system', 'content': f'user: {user}'},
+                chatgpt.get_prompt_message('chat-agent.txt'),   # shared, one per prompt version
+                Message(SYSTEM, f'user: {user}'),
             ]
         return context
 
+    def room_of(self, user: str) -> str:
+        return self.rooms.get(user, DEFAULT_ROOM)
+
+    @staticmethod
+    def is_shared_message(message: Message) -> bool:
+        """
+        every message but the one naming the user, see get_user_context
+        """
+        return not (message.role == SYSTEM and message.content.startswith('user: '))
+
     async def broadcast_head_lines(self, receiver: str, text: str):
         query_summary_html = f"[Q]\n{text[:17]}...\n\n[A]\n"
         response = create_response(
@@ -355,7 +515,8 @@ class ChatGPTThread(threading.Thread):
             sender=f"{self.uname}",
             receiver=f"{receiver}",
             color=CHATGPT_TEXT_COLOR,
-            complete=False
+            complete=False,
+            room=self.room_of(receiver),
         )
         await websocket_manager.broadcast(response)
 
@@ -367,99 +528,435 @@ class ChatGPTThread(threading.Thread):
     def text_to_prompt(text: str):
         return text
 
-    async def broadcast_stream_body(self, *, chatgpt, receiver: str, text: str, context: List, verbose: bool = True):
+    @staticmethod
+    def count_frames(coalescer: DeltaCoalescer, record: Dict):
+        stats = coalescer.stats
+        metrics.count_stream_frames(stats.deltas_in, stats.frames_out)
+        record['frames'] = stats.frames_out
+
+    async def broadcast_stream_body(self, *, chatgpt, receiver: str, text: str, context: List, record: Dict):
+        """
+        stream the reply to the room, what happened is added to `record`, the structured log entry of the request
+        """
         prompt: str = self.text_to_prompt(text)
         full_content: str = ''
 
-        if verbose:
-            print(f"[{time_now_str()}] {self.uname} >> {receiver}")
-        iterator = chatgpt.send_message(text=prompt, context=context, stream=True)
-        for content, status, context, full_content in iterator:
-            response = create_response(f"{content}", complete=False)
-            if verbose:
-                print(content, end='')
-            await websocket_manager.broadcast(response)
-            user_context_dict[receiver] = context
-        if verbose:
-            print()
+        room: str = self.room_of(receiver)
+        start = time.monotonic()
+
+        coalescer = DeltaCoalescer(
+            lambda _content: websocket_manager.publish(
+                create_response(f"{_content}", receiver=f"{receiver}", complete=False, room=room)),
+            window_ms=STREAM_COALESCE_WINDOW_MS,
+            max_bytes=STREAM_COALESCE_MAX_BYTES,
+        )
+        contents = []
+        stored = context
+        iterator = chatgpt.send_message_async(text=prompt, context=context)
+        try:
+            async for content, status, context, full_content in iterator:
+                if len(contents) == 0:
+                    record['first_delta'] = round(time.monotonic() - start, 4)
+                contents.append(content)
+                coalescer.add(content)
+        except asyncio.CancelledError:
+            # upstream stream is closed with the iterator, keep what was said so far unless the user left
+            coalescer.close()
+            self.count_frames(coalescer, record)
+            full_content = ''.join(contents)
+            reason = self.cancel_reasons.pop(receiver, 'stop')
+            if reason == 'stop':
+                # from a copy of the stored context, the stop may land before the first delta
+                context = chatgpt.prepare_context(text=prompt, context=stored)
+                if full_content:
+                    context = chatgpt.update_context(context, full_content)
+                await services.context_store.set_async(receiver, context)
+            record['status'] = reason
+            record['reply_chars'] = len(full_content)
+            if LOG_TOKENS:
+                record['reply'] = full_content
+            response = create_response(f"{self.text_to_html(full_content)}{STOPPED_MSG}",
+                                       time_str=f"{time_now_str()}",
+                                       sender=f"{self.uname}",
+                                       receiver=f"{receiver}",
+                                       color=CHATGPT_TEXT_COLOR,
+                                       complete=True,
+                                       room=room)
+            websocket_manager.publish(response)
+            raise
+        coalescer.close()
+        self.count_frames(coalescer, record)
+        await services.context_store.set_async(receiver, context)
+        record['reply_chars'] = len(full_content)
+        if LOG_TOKENS:
+            record['reply'] = full_content
 
         response = create_response(f"{self.text_to_html(full_content)}",
                                    time_str=f"{time_now_str()}",
                                    sender=f"{self.uname}",
                                    receiver=f"{receiver}",
                                    color=CHATGPT_TEXT_COLOR,
-                                   complete=True)
+                                   complete=True,
+                                   room=room)
         await websocket_manager.broadcast(response)
 
-    async def chatgpt_main(self):
-        chatgpt = self.launch_chatgpt()
+    async def respond(self, sender: str, job: tuple):
+        chatgpt = self.chatgpt
+        msg_id, text, scheduled = job
+        start = time.monotonic()
+        metrics.observe_queue_wait(start - scheduled)
+        record = {
+            'user': sender,
+            'room': self.room_of(sender),
+            'status': 'ok',
+            'queue_wait': round(start - scheduled, 4),
+            'prompt_chars': len(text),
+        }
+        if LOG_TOKENS:
+            record['prompt'] = text
+
+        # noinspection PyBroadException
+        try:
+            ''' call ChatGPT API '''
+            context: List[Dict] = await self.get_user_context(chatgpt=chatgpt, user=sender)
+            context = await self.compactor.apply(sender, context)
+            await self.broadcast_head_lines(receiver=sender, text=text)
+            await self.broadcast_stream_body(
+                chatgpt=chatgpt, receiver=sender, text=text, context=context, record=record)
+            context = await services.context_store.get_async(sender)
+            if context is not None:
+                await self.compactor.schedule(sender, context)
+                record['context_messages'] = len(context)
+                record['context_tokens'] = sum(await chatgpt.count_context_tokens_async(context))
+        except Exception:
+            record['status'] = 'error'
+            logger.exception('reply to %s failed', sender)
+            response = create_response(f"{UNKNOWN_RUNTIME_ERR_MSG}",
+                                       time_str=f"{time_now_str()}",
+                                       sender=f"{self.uname}",
+                                       receiver=f"{sender}",
+                                       color=f"{CHATGPT_TEXT_COLOR}",
+                                       room=self.room_of(sender))
+            await websocket_manager.broadcast(response)
+        finally:
+            record['duration'] = round(time.monotonic() - start, 4)
+            logger.info(f'{self.uname} >> {sender}', extra=record)
+            await services.message_transport.ack(msg_id)
+            self.cancel_reasons.pop(sender, None)   # set by a cancel that came too late to stop anything
+
+    @staticmethod
+    async def keep_leadership():
+        loop = asyncio.get_running_loop()
+        while True:
+            # noinspection PyBroadException
+            try:
+                await loop.run_in_executor(None, services.leader_election.campaign)
+            except Exception:
+                logger.exception('leader election failed')
+            await asyncio.sleep(LEADER_TTL_MS / 1000. / 3)
+
+    async def cancel(self, *, user: str, reason: str):
+        """
+        stop the user's reply in flight, on disconnect also drop the user's queued requests
+        """
+        if user in self.scheduler.running:
+            self.cancel_reasons[user] = reason
+        if reason == 'disconnect':
+            self.rooms.pop(user, None)
+            self.compactor.forget(user)
+        for msg_id, *_ in self.scheduler.cancel(user, drop_pending=reason == 'disconnect'):
+            await services.message_transport.ack(msg_id)
+
+    async def drain(self, timeout: float):
+        """
+        let the replies in flight and queued finish within `timeout`, then stop the rest, keeping what was said
+        jobs dropped from the queue are left unacknowledged, for another worker to claim from a redis stream
+        """
+        scheduler = self.scheduler
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while scheduler.running and loop.time() < deadline:
+            await asyncio.wait(list(scheduler.running.values()), timeout=deadline - loop.time())
+        for user in set(scheduler.pending) | set(scheduler.running):
+            logger.warning('reply to %s stopped by the shutdown', user)
+            scheduler.cancel(user, drop_pending=True)
+        await scheduler.join()
+
+    async def close(self):
+        if self.leadership is not None:
+            self.leadership.cancel()
+            services.leader_election.resign()
+        await self.scheduler.join()
+        await self.chatgpt.aclose()
+
+    async def run(self):
+        """
+        reads the transport until cancelled, the replies in flight are left to drain()
+        """
+        scheduler = self.scheduler
+        message_transport = services.message_transport
+        leader_election = services.leader_election
         response = create_response(f"{self.uname} {ENTER_ROOM_MSG} ", italic=True, color=CHATGPT_TEXT_COLOR)
         await websocket_manager.broadcast(response)
+        if leader_election is not None:
+            self.leadership = asyncio.ensure_future(self.keep_leadership())
 
         # noinspection PyBroadException
         try:
             while True:
                 # noinspection PyBroadException
                 try:
-                    queue_pop = redis.brpop(REDIS_MSG_QUEUE, timeout=1.)
-                    if queue_pop is None:
+                    if leader_election is not None and not leader_election.is_leader:
+                        await asyncio.sleep(1.)
+                        continue
+                    received = await message_transport.get()
+                    if received is None:
                         continue
 
                     ''' process input data '''
-                    data: dict = pickle.loads(queue_pop[1])
+                    msg_id, data = received
+                    if 'control' in data:   # stop / disconnect
+                        await message_transport.ack(msg_id)
+                        await self.cancel(user=data.get('sender', ''), reason=data['control'])
+                        continue
                     sender, text, asking_for_response = self.process_data(data)
+                    if asking_for_response:
+                        self.rooms[sender] = data.get('room', DEFAULT_ROOM)
                     if not asking_for_response:
+                        await message_transport.ack(msg_id)
                         continue
                     if len(text) == 0:
+                        await message_transport.ack(msg_id)
                         await self.alert_empty_input(receiver=sender)
                         continue
 
-                    ''' call ChatGPT API '''
-                    print(f'[{time_now_str()}] {sender}')
-                    print(text)
-                    context: List[Dict] = self.get_user_context(chatgpt=chatgpt, user=sender)
-                    await self.broadcast_head_lines(receiver=sender, text=text)
-                    await self.broadcast_stream_body(
-                        chatgpt=chatgpt, receiver=sender, text=text, context=context, verbose=True)
-                    n_tokens_list = chatgpt.count_context_tokens(user_context_dict[sender])
-                    print(f'[context size]: {n_tokens_list} -> total {sum(n_tokens_list)} tokens')
-                    print()
-                    # await asyncio.sleep(1.)
+                    ''' rate limit by request count and estimated tokens '''
+                    cost = await self.estimate_cost(user=sender, text=text)
+                    retry_after = self.rate_limiter.acquire(sender, cost)
+                    if retry_after is not None:
+                        await message_transport.ack(msg_id)
+                        await self.alert(sender, RATE_LIMITED_MSG.format(int(retry_after) + 1))
+                        continue
+
+                    ''' schedule ChatGPT reply, fair across senders, acknowledged once answered '''
+                    position = scheduler.submit(sender, (msg_id, text, time.monotonic()), cost=cost)
+                    if position > 0:
+                        await self.alert(sender, QUEUED_MSG.format(position))
 
                 except ConnectionError:
                     break
-                except ValueError:
+                except RuntimeError:    # executor shut down, interpreter is exiting
                     break
                 except KeyboardInterrupt:
                     break
                 except Exception:
-                    traceback.print_exc()
+                    logger.exception('failed to process a message')
                     response = create_response(f"{UNKNOWN_RUNTIME_ERR_MSG}",
                                                time_str=f"{time_now_str()}",
                                                sender=f"{self.uname}",
                                                color=f"{CHATGPT_TEXT_COLOR}")
                     await websocket_manager.broadcast(response)
         except Exception:
-            traceback.print_exc()
-        finally:
-            pass
+            logger.exception('chatgpt consumer stopped')
 
-    def main(self):
-        asyncio.run(self.chatgpt_main())
 
-
-chatgpt_thread = ChatGPTThread()
-chatgpt_thread.setDaemon(True)
-chatgpt_thread.start()
+def keep_network_alive(stopped: threading.Event, cooldown: int = 55):
+    while not stopped.is_set():
+        _ = os.popen(f"ping {PING_HOST} -c 3").read()
+        stopped.wait(cooldown)
 
 
-def keep_network_alive(cooldown: int = 55):
-    while True:
-        _ = os.popen(f"ping {PING_HOST} -c 3").read()
-        for i in range(cooldown):
-            time.sleep(1)
+class Services(object):
+    """
+    everything with side effects, started by the app's lifespan instead of on import:
+    start() checks the environment and returns, the store, the tokenizer and the upstream connection pool then
+    warm up in background and in parallel, requests needing them wait for ready
+    """
 
+    def __init__(self):
+        self.redis: Optional[Redis] = None
+        self.message_transport = None
+        self.context_store: Optional[ContextStore] = None
+        self.cluster_bus: Optional[ClusterBus] = None
+        self.presence: Optional[Presence] = None
+        self.leader_election: Optional[LeaderElection] = None
+        self.consumer: Optional[ChatGPTConsumer] = None
+        self.consumer_task: Optional[asyncio.Task] = None
+        self.warm_task: Optional[asyncio.Task] = None
+        self.log_listener = None
+        self.network_alive_thread: Optional[threading.Thread] = None
+        self.stopped = threading.Event()    # tells the threads started here to exit
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.reload_signal: bool = False
+        self.ready: Future = Future()   # not bound to a loop, awaited from whichever loop serves the request
+        self.startup_times: Dict[str, float] = {}
+        self.draining: bool = False
+        self.holders: int = 0   # lifespans sharing the services, e.g. several test clients of one app
+
+    async def start(self):
+        self.holders += 1
+        if self.holders > 1:
+            return
+        start = time.monotonic()
+        os.makedirs(os.path.join(CACHE_DIR, 'log'), exist_ok=True)
+        self.log_listener = setup_logging(os.path.join(CACHE_DIR, 'log'), level=LOG_LEVEL,
+                                          max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT)
+        api_key, api_org = api_credentials()
+        check_tokenizer_assets(TOKENIZER_DIR, CHATGPT_MODEL)
+        # store and cache calls of the replies in flight, the blocking transport read, and the warm-up steps
+        loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_COMPLETIONS + 4)
+        loop.set_default_executor(self.executor)
+        self.ready = Future()
+        self.startup_times = {}
+        self.draining = False
+        self.warm_task = asyncio.ensure_future(self.warm_up(start, api_key=api_key, api_org=api_org))
+        self.stopped.clear()
+        self.network_alive_thread = threading.Thread(target=keep_network_alive, args=(self.stopped,), daemon=True)
+        self.network_alive_thread.start()
+
+    def open_store(self):
+        """
+        blocking, starts the redis server, and joins the cluster if any
+        """
+        os.makedirs(os.path.dirname(REDIS_PATH), exist_ok=True)
+        redis = redislite.Redis(REDIS_PATH)
+        if MSG_TRANSPORT == 'redis':    # shared by the workers of the cluster, consumed by the elected leader
+            self.message_transport = RedisStreamTransport(redis, stream=REDIS_MSG_STREAM, group=REDIS_MSG_GROUP)
+        else:   # single process, no IPC
+            self.message_transport = LocalTransport()
+        self.context_store = ContextStore(
+            redis,
+            prefix=REDIS_CONTEXT_PREFIX,
+            max_user_bytes=CONTEXT_MAX_USER_BYTES,
+            max_hot_bytes=0 if CLUSTER_MODE else CONTEXT_MAX_HOT_BYTES,    # not invalidated across nodes
+            idle_ttl=CONTEXT_IDLE_TTL,
+        )
+        if CLUSTER_MODE:
+            # frames are relayed to the other workers / nodes, online users are tracked cluster-wide,
+            # and a single elected worker consumes the messages for ChatGPT
+            self.cluster_bus = ClusterBus(redis, channel=CLUSTER_CHANNEL)
+            self.cluster_bus.attach(websocket_manager)
+            self.presence = Presence(redis, ttl=PRESENCE_TTL)
+            self.presence.start()
+            self.leader_election = LeaderElection(redis, ttl_ms=LEADER_TTL_MS)
+        self.redis = redis
+
+    async def timed(self, step: str, awaitable):
+        start = time.monotonic()
+        try:
+            return await awaitable
+        finally:
+            seconds = time.monotonic() - start
+            self.startup_times[step] = round(seconds, 4)
+            metrics.observe_startup(step, seconds)
+
+    async def warm_chatgpt(self, *, api_key: str, api_org: str):
+        loop = asyncio.get_running_loop()
+        chatgpt = await self.timed('chatgpt', loop.run_in_executor(
+            None, lambda: ChatGPTConsumer.launch_chatgpt(api_key=api_key, api_org=api_org)))
+        await self.timed('upstream', chatgpt.warm_up())
+        return chatgpt
+
+    async def warm_up(self, start: float, *, api_key: str, api_org: str):
+        loop = asyncio.get_running_loop()
+        # noinspection PyBroadException
+        try:
+            chatgpt, _ = await asyncio.gather(
+                self.warm_chatgpt(api_key=api_key, api_org=api_org),
+                self.timed('store', loop.run_in_executor(None, self.open_store)),
+            )
+            chatgpt.response_cache = ChatGPTConsumer.create_response_cache(self.redis)
+            self.consumer = ChatGPTConsumer(chatgpt)
+            self.consumer_task = asyncio.ensure_future(self.consumer.run())
+            self.watch_reload_signal()
+        except Exception as err:
+            logger.exception('warm-up failed')
+            self.ready.set_exception(err)
+            return
+        total = time.monotonic() - start
+        self.startup_times['total'] = round(total, 4)
+        metrics.observe_startup('total', total)
+        logger.info('ready', extra=self.startup_times)
+        if total > STARTUP_BUDGET:
+            logger.warning('startup took %.2fs, over the budget of %.2fs', total, STARTUP_BUDGET)
+        self.ready.set_result(True)
+
+    def watch_reload_signal(self):
+        """
+        `kill -HUP <pid>` rereads the prompt files right away
+        """
+        if not hasattr(signal, 'SIGHUP'):
+            return
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.reload_prompts)
+            self.reload_signal = True
+        except (RuntimeError, ValueError):  # not on the main thread, e.g. under a test client
+            pass
 
-network_alive_thread = threading.Thread(target=keep_network_alive)
-network_alive_thread.setDaemon(True)
-network_alive_thread.start()
+    def reload_prompts(self):
+        if self.consumer is not None:
+            names = self.consumer.chatgpt.reload_prompts()
+            logger.info('prompts reloaded', extra={'prompts': names})
+
+    async def wait_ready(self):
+        await asyncio.wrap_future(self.ready)
+
+    def status(self) -> str:
+        if self.draining:
+            return 'draining'
+        if not self.ready.done():
+            return 'starting'
+        if self.ready.exception() is not None:
+            return 'failed'
+        return 'ready'
+
+    async def stop(self):
+        self.holders -= 1
+        if self.holders > 0:
+            return
+        self.draining = True
+        if self.warm_task is not None and not self.warm_task.done():
+            self.warm_task.cancel()
+            await asyncio.gather(self.warm_task, return_exceptions=True)
+        if self.consumer is not None:
+            # no new messages are read, the replies already scheduled are given DRAIN_TIMEOUT to finish
+            self.consumer_task.cancel()
+            await asyncio.gather(self.consumer_task, return_exceptions=True)
+            await self.consumer.drain(DRAIN_TIMEOUT)
+            await self.consumer.close()     # also the upstream connections and the tokenizer pools
+            self.consumer = None
+            self.consumer_task = None
+        # then the rest, in reverse order of start
+        loop = asyncio.get_running_loop()
+        if self.reload_signal:
+            loop.remove_signal_handler(signal.SIGHUP)
+            self.reload_signal = False
+        await websocket_manager.close_all()
+        await loop.run_in_executor(None, self.close_store)
+        self.stopped.set()
+        if self.network_alive_thread is not None:
+            await loop.run_in_executor(None, self.network_alive_thread.join, 5.)
+            self.network_alive_thread = None
+        logger.info('stopped')
+        stop_logging(self.log_listener)
+        self.log_listener = None
+        self.executor.shutdown(wait=False)
+        self.executor = None
+
+    def close_store(self):
+        """
+        blocking, counterpart of open_store
+        """
+        if self.cluster_bus is not None:
+            self.cluster_bus.close()
+        if self.presence is not None:
+            self.presence.close()
+        if self.redis is not None:
+            self.redis.close()
+        # redislite stops its server once the last client is collected
+        self.cluster_bus = self.presence = self.leader_election = None
+        self.message_transport = self.context_store = self.redis = None
+
+
+services = Services()
@@ -0,0 +1,58 @@
+import asyncio
+
+import httpx
+import pytest
+
+from benchmark.fake_openai import UpstreamProfile, create_app
+from chatgpt_api import ChatGPT, Message, SYSTEM
+from chatgpt_api.tokenizer import missing_assets
+from config.config_en import Args
+
+pytestmark = pytest.mark.skipif(missing_assets(Args.TOKENIZER_DIR, Args.CHATGPT_MODEL),
+                                reason='tokenizer files not prebuilt, see install.sh')
+
+
+def is_shared_message(message: Message) -> bool:
+    return not (message.role == SYSTEM and message.content.startswith('user: '))   # as main.ChatGPTConsumer
+
+
+def test_two_users_share_one_upstream_stream():
+    upstream = create_app(UpstreamProfile(ttft=0.2, tokens_per_second=200., jitter=0., reply_tokens=20))
+    requests = []
+
+    async def counting_app(scope, receive, send):
+        if scope['type'] == 'http' and scope['path'].endswith('/chat/completions'):
+            requests.append(scope['path'])
+        await upstream(scope, receive, send)
+
+    # the shipped config, with cross-user sharing turned on as SINGLE_FLIGHT requires
+    chatgpt = ChatGPT(
+        api_key='sk-test',
+        api_org='org-test',
+        prompts_dir=Args.PROMPTS_DIR,
+        tokenizer_dir=Args.TOKENIZER_DIR,
+        model_name=Args.CHATGPT_MODEL,
+        temperature=Args.CHATGPT_TEMPERATURE,
+        cache_key_filter=is_shared_message,
+        single_flight=True,
+    )
+
+    async def ask(user: str, delay: float):
+        await asyncio.sleep(delay)
+        context = [chatgpt.get_prompt_message('chat-agent.txt'), Message(SYSTEM, f'user: {user}')]
+        async for _, status, context, full_content in chatgpt.send_message_async(text='hello', context=context):
+            if status:
+                return context, full_content
+
+    async def main():
+        chatgpt.http_client = httpx.AsyncClient(transport=httpx.ASGITransport(app=counting_app),
+                                                base_url='http://upstream/v1')
+        try:
+            return await asyncio.gather(ask('alice', 0.), ask('bob', 0.05))
+        finally:
+            await chatgpt.aclose()
+
+    (alice_context, alice_reply), (bob_context, bob_reply) = asyncio.run(main())
+    assert len(requests) == 1
+    assert alice_reply == bob_reply != chatgpt.network_err_text
+    assert alice_context[1].content == 'user: alice' and bob_context[1].content == 'user: bob'
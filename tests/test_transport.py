@@ -0,0 +1,36 @@
+import time
+
+import redislite
+
+from chatroom.transport import RedisStreamTransport
+
+
+def make_transports(tmp_path, claim_idle_ms: int):
+    redis = redislite.Redis(str(tmp_path / 'redis.db'))
+    return redis, [RedisStreamTransport(redis, consumer=consumer, block_ms=10, claim_idle_ms=claim_idle_ms)
+                   for consumer in ['leader', 'standby']]
+
+
+def test_own_pending_messages_are_not_claimed_again(tmp_path):
+    redis, (leader, _) = make_transports(tmp_path, claim_idle_ms=300)
+    leader._ensure_group()
+    redis.xadd(leader.stream, {'sender': 'alice', 'message': 'hi'})
+
+    msg_id, data = leader._read()
+    assert data == {'sender': 'alice', 'message': 'hi'}
+
+    time.sleep(0.5)     # still being answered, past claim_idle_ms
+    assert leader._read() is None
+
+
+def test_pending_messages_of_another_consumer_are_claimed(tmp_path):
+    redis, (leader, standby) = make_transports(tmp_path, claim_idle_ms=300)
+    leader._ensure_group()
+    redis.xadd(leader.stream, {'sender': 'alice', 'message': 'hi'})
+
+    msg_id, _ = leader._read()
+    time.sleep(0.5)     # the leader died without ack
+    claimed_id, data = standby._read()
+    assert claimed_id == msg_id
+    assert data == {'sender': 'alice', 'message': 'hi'}
+    assert standby._read() is None